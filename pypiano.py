@@ -4,6 +4,11 @@
 """
 PyPiano!
 This application makes you to be easy to read musical scores rapidly.
+
+This module includes unit test suite for itself.
+Please execute following command on your shell.
+
+$ python pypiano.py --unittest
 """
 
 __author__    = 'MIYAZAKI Masafumi (The Project Fukurous)'
@@ -14,15 +19,32 @@ __copyright__ = "Copyright 2017-2018 MIYAZAKI Masafumi (The Project Fukurous)"
 __license__   = 'The 2-Clause BSD License'
 
 
+import array
+import bisect
+import collections
+import concurrent.futures
 import datetime
+import gzip
+import hashlib
+import heapq
+import json
+import mmap
+import os
 import org.fukurous.utils.filesystem
 import pygame
 from   pygame.locals import QUIT
 import pygame.midi
 import pygame.transform
+import queue
 import random
 import re
+import shutil
+import struct
 import sys
+import tempfile
+import threading
+import time
+import unittest
 import xml.etree.ElementTree
 
 
@@ -30,31 +52,51 @@ class PyPiano(object):
 
     FILE_FOR_PROPERTIES = "./xml/properties.xml"
     FILE_FOR_LOGGER = "./logs/log.txt"
+    MIDI_INPUT_EVENT = pygame.USEREVENT
 
     def __init__(self):
         self.props = Properties(PyPiano.FILE_FOR_PROPERTIES)
         self.WINDOW_TITLE = self.props.get("WindowTitle")
-        self.SCREEN_SIZE = (int(self.props.get("WindowWidth")), int(self.props.get("WindowHeight")))
+        self.SCREEN_SIZE = (self.props.get_int("WindowWidth"), self.props.get_int("WindowHeight"))
         self.COLOR_WHITE = (255, 255, 255)
         self.COLOR_TRANSPARENCY = (255, 255, 255, 0)
         self.EXIT_SUCCESS = 0
         self.EXIT_FAILURE = 1
         self.midi_input_device = None
+        self.midi_input_reader = None
         self.midi_output_device = None
-        self.canvas = None   # Surface for drawing
-        self.screen = None   # Surface for displaying
-        self.practice_cases = PracticeCases(self.props.get("DirectoryForCases"))
-        self.practice_suites = PracticeSuites(self.props.get("DirectoryForSuites"))
+        self.scaled_canvas = None   # Surface for drawing, scaled by DisplayScale
+        self.screen = None          # Surface for displaying
+        self.displayed_canvas_rect = None   # Area of the screen covered by the last canvas
+        self.canvas_answer_area = None      # Area of the canvas changed by drawing the answer
+        self.case_generator = CaseGenerator(self.props.get_layout())
+        self.practice_cases = PracticeCases(self.props.get("DirectoryForCases"), self.props.get("CatalogFormat") == "columnar",
+                                            self.case_generator)
+        self.practice_suites = PracticeSuites(self.props.get("DirectoryForSuites"), self.props.get_seed(),
+                                              CaseIndex(self.practice_cases, self.props.get_layout()), self.case_generator,
+                                              self.practice_cases)
+        self.current_suite = None
         self.previous_case = None
         self.current_case = None
-        self.notes_image_height = 1500
-        self.pressing_keys = list()
-        self.log_file = None
+        self.wrong_answers = 0   # Wrong keys pressed while waiting for the current answer
+        self.chord_recognizer = ChordRecognizer()
+        self.keyboard_state = KeyboardState()
+        self.displayed_time = None   # perf_counter_ns() when the current case was displayed
+        self.answered_time = None    # perf_counter_ns() when the current case was answered
+        self.reaction_times = ReactionTimes()
+        self.notes_image = None        # Note layer, allocated once and cleared in place
+        self.notes_image_rects = list()   # Areas of the note layer drawn by the last render
+        self.logger = None
+        self.image_cache = SurfaceCache(self.props.get_int("ImageCacheBytes"))
+        self.texture_atlas = None   # Images packed by "--build-atlas". Others are loaded one by one.
+        self.scaled_canvases = SurfaceCache(self.props.get_int("ScaledCanvasCacheBytes"))
+        self.staff_compositor = StaffCompositor(self.props, self.get_image, self.props.get_int("StaffCacheBytes"))
 
     def perform(self):
         try:
             self.initialize()
             self.write_info_log("PyPiano started.")
+            self.write_duplicates_log()
             self.select_input_device()
             self.select_output_device()
             self.select_suite()
@@ -71,7 +113,8 @@ class PyPiano(object):
         return self.EXIT_SUCCESS
 
     def initialize(self):
-        self.log_file = open(PyPiano.FILE_FOR_LOGGER, "a")
+        self.logger = Logger(PyPiano.FILE_FOR_LOGGER, self.props)
+        self.logger.start()
         pygame.init()
         pygame.midi.init()
         pygame.fastevent.init()
@@ -79,12 +122,33 @@ class PyPiano(object):
         pygame.display.set_caption(self.WINDOW_TITLE)
         self.screen.fill(self.COLOR_WHITE)
         pygame.display.update()
+        if self.props.get("UseTextureAtlas") == "True":
+            self.load_texture_atlas()
+        if self.props.get("PreloadImages") == "True":
+            self.preload_images()
+
+    def load_texture_atlas(self):
+        try:
+            self.texture_atlas = TextureAtlas(self.props.get("TextureAtlas"), self.props.get("TextureAtlasIndex"))
+        except (OSError, ValueError, KeyError, pygame.error) as exception:
+            self.write_warning_log("Texture atlas not loaded : " + str(exception))
+
+    def preload_images(self):
+        for filename in self.props.get_image_filenames():
+            self.get_image(filename)
 
     def select_input_device(self):
         input_devices = self.get_midi_input_devices()
+        self.flush_log()
         self.print_device_list(input_devices)
         device_id = int(input("Choose device_id: "))
         self.midi_input_device = pygame.midi.Input(device_id)
+        poll_interval = self.props.get_int("MidiPollInterval") / 1000
+        idle_poll_interval = self.props.get_int("MidiIdlePollInterval") / 1000
+        active_window = self.props.get_int("MidiActiveWindow") / 1000
+        self.midi_input_reader = MidiInputReader(self.midi_input_device, PyPiano.MIDI_INPUT_EVENT, poll_interval,
+                                                 idle_poll_interval, active_window)
+        self.midi_input_reader.start()
         self.write_info_log("MIDI input device connected")
 
     def get_midi_input_devices(self):
@@ -103,6 +167,7 @@ class PyPiano(object):
 
     def select_output_device(self):
         output_devices = self.get_midi_output_devices()
+        self.flush_log()
         self.print_device_list(output_devices)
         device_id = int(input("Choose device_id: "))
         self.midi_output_device = pygame.midi.Output(device_id)
@@ -131,11 +196,27 @@ class PyPiano(object):
         print("============================")
 
     def select_suite(self):
-        suite_list = self.practice_suites.get_list()
-        self.print_suite_list(suite_list)
-        suite_index = int(input("Choose suite_id: "))
-        suite_id = suite_list[suite_index]
-        self.current_suite = self.practice_suites.get_by_id(suite_id)
+        while self.current_suite is None:
+            suite_list = self.practice_suites.get_list()
+            self.flush_log()
+            self.print_suite_list(suite_list)
+            suite_index = int(input("Choose suite_id: "))
+            suite_id = suite_list[suite_index]
+            try:
+                self.current_suite = self.practice_suites.get_by_id(suite_id)
+            except EmptySuiteException as exception:
+                self.write_warning_log(str(exception))   # Left out of the list from now on. Choose again.
+            for (case_id, keys) in self.practice_suites.get_untransposed(suite_id):
+                self.write_warning_log("Case(" + case_id + ") in Suite(" + suite_id + ") not transposed into " + " ".join(keys))
+        self.practice_cases.load(self.current_suite.get_case_ids())
+        if self.current_suite.is_adaptive():
+            try:
+                self.current_suite.load_schedule(self.get_schedule_filename())
+            except (OSError, ValueError) as exception:
+                self.write_warning_log("Schedule not loaded. Starting a new one : " + str(exception))
+
+    def get_schedule_filename(self):
+        return os.path.join(self.props.get("DirectoryForSchedules"), self.current_suite.get_id() + ".dat")
 
     def print_suite_list(self, suite_list):
         print("========== Suites ==========")
@@ -151,6 +232,7 @@ class PyPiano(object):
             self.display_case()
             self.write_pre_answer_log()
             self.wait_answer()
+            self.record_answer()
             self.write_post_answer_log()
             self.display_answer()
             self.wait_interval()
@@ -161,7 +243,8 @@ class PyPiano(object):
         self.current_case = self.practice_cases.get_by_id(current_case_id)
 
     def display_case(self):
-        self.screen.fill(self.COLOR_WHITE)
+        if self.midi_input_reader is not None:
+            self.midi_input_reader.set_awaiting(True)
         if isinstance(self.current_case, PracticeCaseAsScore):
             self.draw_case_as_score()
         elif isinstance(self.current_case, PracticeCaseAsChord):
@@ -172,199 +255,206 @@ class PyPiano(object):
         else:
             pass   # Unexpected case. Nothing to do....
         self.display_canvas_on_screen()
-        pygame.display.update()
+        self.displayed_time = time.perf_counter_ns()
 
     def draw_case_as_score(self, is_as_answer = None):
-        head_image  = self.get_head_image()
-        key_image   = self.get_key_image()
-        lines_image = self.get_lines_image()
-        notes_image = self.get_notes_image(is_as_answer)
-        whole_width  = head_image.get_width() + key_image.get_width() + lines_image.get_width()
-        whole_height = max(head_image.get_height(), key_image.get_height(), lines_image.get_height())
-        self.canvas = pygame.Surface((whole_width, whole_height))
-        self.canvas.fill(self.COLOR_WHITE)
-        head_position_x  = 0
-        key_position_x   = head_position_x  + head_image.get_width()
-        lines_position_x = key_position_x   + key_image.get_width()
-        notes_position_x = lines_position_x + int(self.props.get("NoteOffsetX"))
-        self.canvas.blit(head_image,  (head_position_x,  0))
-        self.canvas.blit(key_image,   (key_position_x,   0))
-        self.canvas.blit(lines_image, (lines_position_x, 0))
-        self.canvas.blit(notes_image, (notes_position_x, 0))
-
-    def get_head_image(self):
-        return self.get_image(self.props.get("HeadImage"))
-
-    def get_key_image(self):
-        return self.get_image(self.props.get("KeyImage_" + self.current_case.get_key()))
-
-    def get_lines_image(self):
-        base_image = self.get_image(self.props.get("LineImage_Base"))
-        scaled_width = int(self.props.get("LineWidth"))
-        scaled_height = base_image.get_height()
-        scaled_image = pygame.transform.scale(base_image, (scaled_width, scaled_height))
-        additional_lines_image = self.get_additional_lines_image()
-        if additional_lines_image is not None:
-            additional_lines_offset_x = int(self.props.get("AdditionalLinesOffsetX"))
-            scaled_image.blit(additional_lines_image, (additional_lines_offset_x, 0))
-        return scaled_image
-
-    def get_additional_lines_image(self):
-        additional_line_images = self.get_additional_line_images()
-        if len(additional_line_images) == 0:
-            return None
-        base_image = additional_line_images.pop()
-        for additional_line_image in additional_line_images:
-            base_image.blit(additional_line_image, (0, 0))
-        scaled_width = int(self.props.get("AdditionalLinesWidth"))
-        scaled_height = base_image.get_height()
-        scaled_image = pygame.transform.scale(base_image, (scaled_width, scaled_height))
-        return scaled_image
-
-    def get_additional_line_images(self):
-        dictionary = dict()
+        key = self.current_case.get_key()
+        line_mask = self.get_additional_line_mask()
+        (staff_width, staff_height) = self.staff_compositor.get_staff_size(key)
+        notes_position_x = self.staff_compositor.get_notes_position_x(staff_width)
+        notes_width = self.get_note_image(is_as_answer).get_width() * PracticeCase.NUMBER_OF_COLUMNS
+        self.canvas_answer_area = pygame.Rect(notes_position_x, 0, notes_width, staff_height)
+        is_wide = 1 in self.current_case.get_columns()   # Ledger lines also reach the note moved to the right.
+        notes_key = tuple(note.get_position_index() for note in self.current_case.get_notes())
+        canvas_key = ("score", key, line_mask, is_wide, notes_key, bool(is_as_answer))
+        self.set_canvas(canvas_key, lambda: self.compose_score_canvas(key, line_mask, is_wide, notes_position_x, is_as_answer))
+
+    def compose_score_canvas(self, key, line_mask, is_wide, notes_position_x, is_as_answer):
+        canvas = self.staff_compositor.get_staff_image(key, line_mask, is_wide).copy()
+        canvas.blit(self.get_notes_image(is_as_answer), (notes_position_x, 0))
+        return canvas
+
+    def get_additional_line_mask(self):
+        layout = self.props.get_layout()
+        line_mask = 0
         for note in self.current_case.get_notes():
-            note_name = note.get_position_name()
-            note_step = note.get_step()
-            if note_step:
-                note_y = int(self.props.get("NotePositionY_" + note_name + "_" + note_step))
-            else:
-                note_y = int(self.props.get("NotePositionY_" + note_name))
-            if note_y <= int(self.props.get("NotePositionY_B6")):
-                self.add_line_image_into_dictionary("LineImage_Upper_Top5th", dictionary)
-            if note_y <= int(self.props.get("NotePositionY_G6")):
-                self.add_line_image_into_dictionary("LineImage_Upper_Top4th", dictionary)
-            if note_y <= int(self.props.get("NotePositionY_E6")):
-                self.add_line_image_into_dictionary("LineImage_Upper_Top3rd", dictionary)
-            if note_y <= int(self.props.get("NotePositionY_C6")):
-                self.add_line_image_into_dictionary("LineImage_Upper_Top2nd", dictionary)
-            if note_y <= int(self.props.get("NotePositionY_A5")):
-                self.add_line_image_into_dictionary("LineImage_Upper_Top1st", dictionary)
-            if (note.step is None and
-                note_y >= int(self.props.get("NotePositionY_C4_Upper")) and
-                note_y <= int(self.props.get("NotePositionY_G3_Upper"))):
-                self.add_line_image_into_dictionary("LineImage_Upper_Bottom1st", dictionary)
-            if (note.step is None and
-                note_y >= int(self.props.get("NotePositionY_A3_Upper")) and
-                note_y <= int(self.props.get("NotePositionY_G3_Upper"))):
-                self.add_line_image_into_dictionary("LineImage_Upper_Bottom2nd", dictionary)
-            if (note.step == "Upper" and
-                note_y >= int(self.props.get("NotePositionY_C4_Upper")) and
-                note_y <= int(self.props.get("NotePositionY_G3_Upper"))):
-                self.add_line_image_into_dictionary("LineImage_Upper_Bottom1st", dictionary)
-            if (note.step == "Upper" and
-                note_y >= int(self.props.get("NotePositionY_A3_Upper")) and
-                note_y <= int(self.props.get("NotePositionY_G3_Upper"))):
-                self.add_line_image_into_dictionary("LineImage_Upper_Bottom2nd", dictionary)
-            if (note.step == "Lower" and
-                note_y >= int(self.props.get("NotePositionY_F4_Lower")) and
-                note_y <= int(self.props.get("NotePositionY_E4_Lower"))):
-                self.add_line_image_into_dictionary("LineImage_Lower_Top2nd", dictionary)
-            if (note.step == "Lower" and
-                note_y >= int(self.props.get("NotePositionY_F4_Lower")) and
-                note_y <= int(self.props.get("NotePositionY_C4_Lower"))):
-                self.add_line_image_into_dictionary("LineImage_Lower_Top1st", dictionary)
-            if note_y >= int(self.props.get("NotePositionY_E2")):
-                self.add_line_image_into_dictionary("LineImage_Lower_Bottom1st", dictionary)
-            if note_y >= int(self.props.get("NotePositionY_C2")):
-                self.add_line_image_into_dictionary("LineImage_Lower_Bottom2nd", dictionary)
-            if note_y >= int(self.props.get("NotePositionY_A1")):
-                self.add_line_image_into_dictionary("LineImage_Lower_Bottom3rd", dictionary)
-            if note_y >= int(self.props.get("NotePositionY_F1")):
-                self.add_line_image_into_dictionary("LineImage_Lower_Bottom4th", dictionary)
-            if note_y >= int(self.props.get("NotePositionY_D1")):
-                self.add_line_image_into_dictionary("LineImage_Lower_Bottom5th", dictionary)
-        return list(dictionary.values())
-
-    def add_line_image_into_dictionary(self, key, dictionary):
-        if key not in dictionary.keys():
-            dictionary[key] = self.get_image(self.props.get(key))
+            line_mask = line_mask | layout.get_line_mask_of(note)
+        return line_mask
 
-    def get_notes_image(self, is_as_answer = None):
+    def get_note_image(self, is_as_answer = None):
         if is_as_answer:
-            note_image = self.get_image(self.props.get("NoteImageAsAnswer"))
-        else:
-            note_image = self.get_image(self.props.get("NoteImage"))
-        notes_image = pygame.Surface((note_image.get_width(), self.notes_image_height)).convert_alpha()
-        notes_image.fill(self.COLOR_TRANSPARENCY)
-        for note in self.current_case.get_notes():
-            note_name = note.get_position_name()
-            note_step = note.get_step()
-            if note_step:
-                note_y = int(self.props.get("NotePositionY_" + note_name + "_" + note_step))
-            else:
-                note_y = int(self.props.get("NotePositionY_" + note_name))
-            if (note_y + note_image.get_height()) > self.notes_image_height:
-                self.notes_image_height = note_y + note_image.get_height()
-                notes_image = pygame.Surface((note_image.get_width(), self.notes_image_height)).convert_alpha()
-                notes_image.fill(self.COLOR_TRANSPARENCY)
-            notes_image.blit(note_image, (0, note_y))
+            return self.get_image(self.props.get("NoteImageAsAnswer"))
+        return self.get_image(self.props.get("NoteImage"))
+
+    def get_notes_image(self, is_as_answer = None):
+        note_image = self.get_note_image(is_as_answer)
+        layout = self.props.get_layout()
+        notes_image = self.get_notes_layer(note_image.get_size())
+        for rect in self.notes_image_rects:
+            notes_image.fill(self.COLOR_TRANSPARENCY, rect)
+        self.notes_image_rects.clear()
+        for (note, column) in zip(self.current_case.get_notes(), self.current_case.get_columns()):
+            note_position = (column * note_image.get_width(), layout.get_note_position_y_of(note))
+            self.notes_image_rects.append(notes_image.blit(note_image, note_position))
         return notes_image
 
+    def get_notes_layer(self, note_size):
+        (note_width, note_height) = note_size
+        note_width = note_width * PracticeCase.NUMBER_OF_COLUMNS   # The upper note of a second is moved to the right.
+        layer_height = self.props.get_layout().get_max_note_position_y() + note_height   # Room for the lowest note
+        if (self.notes_image is None) or (self.notes_image.get_size() != (note_width, layer_height)):
+            self.notes_image = pygame.Surface((note_width, layer_height)).convert_alpha()
+            self.notes_image.fill(self.COLOR_TRANSPARENCY)
+            self.notes_image_rects.clear()
+        return self.notes_image
+
     def get_image(self, filename):
+        if self.texture_atlas is not None:
+            image = self.texture_atlas.get(filename)
+            if image is not None:
+                return image
+        return self.image_cache.get(filename, self.load_image)
+
+    def load_image(self, filename):
         return pygame.image.load(filename).convert_alpha()
 
     def draw_case_as_chord(self, is_as_answer = None):
-        pass   ##### TODO #####
+        self.draw_case_as_score(is_as_answer)   # Chords are voiced at load time and drawn like scores.
 
     def draw_case_as_sound(self, is_as_answer = None):
-        whole_width = int(self.props.get("WindowWidth"))
-        whole_height = int(self.props.get("WindowHeight"))
+        whole_width = self.props.get_int("WindowWidth")
+        whole_height = self.props.get_int("WindowHeight")
         if is_as_answer:
             speaker_image = self.get_image(self.props.get("SpeakerImageAsAnswer"))
         else:
             speaker_image = self.get_image(self.props.get("SpeakerImage"))
-        position_x = (whole_width - speaker_image.get_width()) / 2
-        position_y = (whole_height - speaker_image.get_height()) / 2
-        self.canvas = pygame.Surface((whole_width, whole_height))
-        self.canvas.fill(self.COLOR_WHITE)
-        self.canvas.blit(speaker_image, (position_x, position_y))
+        position_x = int((whole_width - speaker_image.get_width()) / 2)
+        position_y = int((whole_height - speaker_image.get_height()) / 2)
+        self.canvas_answer_area = pygame.Rect((position_x, position_y), speaker_image.get_size())
+        canvas_key = ("sound", bool(is_as_answer))
+        self.set_canvas(canvas_key, lambda: self.compose_sound_canvas(speaker_image, self.canvas_answer_area))
+
+    def compose_sound_canvas(self, speaker_image, speaker_area):
+        canvas = pygame.Surface(self.SCREEN_SIZE)
+        canvas.fill(self.COLOR_WHITE)
+        canvas.blit(speaker_image, speaker_area)
+        return canvas
+
+    def set_canvas(self, canvas_key, create_canvas):
+        scale = self.props.get_float("DisplayScale")
+        create_scaled_canvas = lambda scaled_key: self.scale_canvas(create_canvas(), scale)
+        self.scaled_canvas = self.scaled_canvases.get((canvas_key, scale), create_scaled_canvas)
+
+    def scale_canvas(self, canvas, scale):
+        scaled_size = (int(canvas.get_width() * scale), int(canvas.get_height() * scale))
+        if self.props.get("ScaleSmoothly") == "True":
+            return pygame.transform.smoothscale(canvas, scaled_size)
+        return pygame.transform.scale(canvas, scaled_size)
+
+    def set_display_scale(self, scale):
+        self.props.set("DisplayScale", str(scale))
+        self.scaled_canvases.clear()
 
     def play_case_as_sound(self):
+        layout = self.props.get_layout()
+        velocity = self.props.get_int("SoundVelocity")
         for note in self.current_case.get_notes():
-            note_number_string = self.props.get("NoteNumber_" + note.get_name())
-            note_number = int(note_number_string)
-            velocity = int(self.props.get("SoundVelocity"))
+            note_number = layout.get_note_number_of(note)
             self.midi_output_device.note_off(note_number)
             self.midi_output_device.note_on(note_number, velocity)
 
-    def display_canvas_on_screen(self):
-        scaled_width = int(self.canvas.get_width() * float(self.props.get("DisplayScale")))
-        scaled_height = int(self.canvas.get_height() * float(self.props.get("DisplayScale")))
-        scaled_canvas = pygame.transform.scale(self.canvas, (scaled_width, scaled_height))
-        start_x = (self.screen.get_width() - scaled_canvas.get_width()) / 2
-        start_y = (self.screen.get_height() - scaled_canvas.get_height()) / 2
-        self.screen.blit(scaled_canvas, (start_x, start_y))
+    def display_canvas_on_screen(self, changed_area = None):
+        scale = self.props.get_float("DisplayScale")
+        scaled_canvas = self.scaled_canvas
+        start_x = int((self.screen.get_width() - scaled_canvas.get_width()) / 2)
+        start_y = int((self.screen.get_height() - scaled_canvas.get_height()) / 2)
+        canvas_rect = pygame.Rect((start_x, start_y), scaled_canvas.get_size())
+        if (changed_area is None) or (canvas_rect != self.displayed_canvas_rect):
+            dirty_rects = [canvas_rect]
+            if self.displayed_canvas_rect is not None:
+                self.screen.fill(self.COLOR_WHITE, self.displayed_canvas_rect)
+                dirty_rects.append(self.displayed_canvas_rect)
+            self.screen.blit(scaled_canvas, canvas_rect)
+        else:
+            scaled_area = self.scale_rect(changed_area, scale).clip(scaled_canvas.get_rect())
+            dirty_rect = scaled_area.move(canvas_rect.topleft)
+            self.screen.blit(scaled_canvas, dirty_rect, scaled_area)
+            dirty_rects = [dirty_rect]
+        self.displayed_canvas_rect = canvas_rect
+        pygame.display.update(dirty_rects)
+
+    def scale_rect(self, rect, scale):
+        left   = int(rect.left * scale)
+        top    = int(rect.top * scale)
+        right  = int(rect.right * scale) + 1   # Covers pixels partially sampled from the area.
+        bottom = int(rect.bottom * scale) + 1
+        return pygame.Rect(left, top, right - left, bottom - top)
 
     def wait_answer(self):
-        answer_dictionary = self.create_answer_dictionary()
+        self.set_answer_targets()
+        chord_mask = self.get_answer_chord_mask()
+        self.chord_recognizer.reset()
+        self.wrong_answers = 0
         while True:
-            for event in pygame.event.get():
-                if event.type == QUIT:   # Exit on press Quit button.
-                    raise SystemContinuationException
-            if self.midi_input_device.poll():
-                for event in self.midi_input_device.read(10):
-                    self.write_info_log("MIDI event got : " + str(event))
-                    midi_event = MidiEvent(event)
-                    note_number_string = str(midi_event.get_data1())
-                    if note_number_string in answer_dictionary:
-                        if midi_event.is_note_on():
-                            answer_dictionary[note_number_string] = True
-                        elif midi_event.is_note_off():
-                            answer_dictionary[note_number_string] = False
-                if list(answer_dictionary.values()).count(True) == len(answer_dictionary):
-                    return
-            pygame.time.wait(20)
-
-    def create_answer_dictionary(self):
-        dictionary = dict()
-        for note in self.current_case.get_notes():
-            note_number_string = self.props.get("NoteNumber_" + note.get_name())
-            dictionary[note_number_string] = False
-        return dictionary
+            event = pygame.fastevent.wait()   # Blocks until the reader thread or the window posts an event.
+            if event.type == QUIT:   # Exit on press Quit button.
+                raise SystemContinuationException
+            if event.type != PyPiano.MIDI_INPUT_EVENT:
+                continue
+            if self.logger.is_enabled("Debug"):
+                self.write_debug_log("MIDI event got : " + str(event.raw_event))
+            midi_event = MidiEvent(event.raw_event)
+            if event.received_time < self.displayed_time:   # Played before the case was shown.
+                if midi_event.is_control_change():   # Still follow the pedal.
+                    self.keyboard_state.control_change(midi_event.get_data1(), midi_event.get_data2())
+                continue
+            if chord_mask is not None:
+                is_answered = self.update_chord_answer(midi_event, chord_mask)
+            else:
+                is_answered = self.update_keyboard_state(midi_event)
+            if is_answered:
+                self.answered_time = time.perf_counter_ns()
+                latency = (self.answered_time - event.received_time) // 1000
+                self.write_debug_log("Answer detected " + str(latency) + " us after MIDI input.")
+                self.midi_input_reader.set_awaiting(False)   # Back off until the next case is displayed.
+                return
+
+    def update_keyboard_state(self, midi_event):
+        if midi_event.is_note_on():
+            if not self.keyboard_state.note_on(midi_event.get_data1()):
+                self.wrong_answers = self.wrong_answers + 1
+        elif midi_event.is_note_off():
+            self.keyboard_state.note_off(midi_event.get_data1())
+        elif midi_event.is_control_change():
+            self.keyboard_state.control_change(midi_event.get_data1(), midi_event.get_data2())
+        return self.keyboard_state.is_complete()
+
+    def update_chord_answer(self, midi_event, chord_mask):
+        note_number = midi_event.get_data1()
+        if midi_event.is_note_on():
+            self.chord_recognizer.note_on(note_number)
+            if not chord_mask & ChordRecognizer.get_pitch_class_bit(note_number):
+                self.wrong_answers = self.wrong_answers + 1
+        elif midi_event.is_note_off():
+            self.chord_recognizer.note_off(note_number)
+        else:
+            return False
+        if self.logger.is_enabled("Debug"):
+            self.write_debug_log("Chord recognized : " + self.chord_recognizer.get_name())
+        return (self.chord_recognizer.get_mask() & chord_mask) == chord_mask   # Wrong keys are counted, not blocking.
+
+    def set_answer_targets(self):
+        layout = self.props.get_layout()
+        self.keyboard_state.set_targets(layout.get_note_number_of(note) for note in self.current_case.get_notes())
+
+    def get_answer_chord_mask(self):   # Any voicing or inversion of the chord is accepted.
+        if isinstance(self.current_case, PracticeCaseAsChord) and self.current_case.is_inversion_allowed():
+            layout = self.props.get_layout()
+            return ChordRecognizer.get_pitch_class_mask(layout.get_note_number_of(note) for note in self.current_case.get_notes())
+        return None
 
     def display_answer(self):
-        self.screen.fill(self.COLOR_WHITE)
+        self.canvas_answer_area = None
         if isinstance(self.current_case, PracticeCaseAsScore):
             self.draw_answer_as_score()
         elif isinstance(self.current_case, PracticeCaseAsChord):
@@ -373,8 +463,7 @@ class PyPiano(object):
             self.draw_answer_as_sound()
         else:
             pass   # Unexpected case. Nothing to do....
-        self.display_canvas_on_screen()
-        pygame.display.update()
+        self.display_canvas_on_screen(self.canvas_answer_area)
 
     def draw_answer_as_score(self):
         is_as_answer = True
@@ -390,55 +479,185 @@ class PyPiano(object):
 
     def wait_interval(self):
         pygame.event.pump()
-        pygame.time.wait(int(self.props.get("IntervalTime")))
+        pygame.time.wait(self.props.get_int("IntervalTime"))
+
+    def record_answer(self):
+        reaction_time = (self.answered_time - self.displayed_time) // 1000
+        self.reaction_times.record(self.current_suite.get_id(), self.current_case.get_id(), reaction_time)
+        self.current_suite.record_answer(self.current_case.get_id(), self.wrong_answers, reaction_time)
 
     def write_pre_answer_log(self):
         self.write_info_log_with_action("displayed")
 
     def write_post_answer_log(self):
         self.write_info_log_with_action("answered")
+        self.write_reaction_time_log()
+
+    def write_reaction_time_log(self):
+        reaction_time = (self.answered_time - self.displayed_time) // 1000
+        histogram = self.reaction_times.get_suite_histogram(self.current_suite.get_id())
+        self.write_info_log("Reaction time : " + str(reaction_time) + " us (Suite " + str(histogram) + ")")
 
     def write_info_log_with_action(self, action):
         self.write_info_log("Case(" + self.current_case.get_id() + ") in Suite(" + self.current_suite.get_id() + ") is " + action + ".")
 
+    def write_debug_log(self, message):
+        self.write_log("Debug", message)
+
     def write_info_log(self, message):
-        self.write_log_with_tag("[Info]", message)
+        self.write_log("Info", message)
+
+    def write_warning_log(self, message):
+        self.write_log("Warning", message)
 
     def write_error_log(self, message):
-        self.write_log_with_tag("[Error]", message)
+        self.write_log("Error", message)
+
+    def flush_log(self):   # Keeps log lines ahead of the lists and prompts printed on this thread.
+        if self.logger is not None:
+            self.logger.flush()
+
+    def write_log(self, level, message):
+        if self.logger is None:   # Not initialized yet.
+            print(Logger.format_as_text(time.time(), level, message))
+            return
+        self.logger.write(level, message)
 
-    def write_log_with_tag(self, tag, message):
-        timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
-        self.write_log("[" + timestamp + "]" + tag + " " + message)
+    def write_duplicates_log(self):
+        duplicates = self.practice_cases.get_duplicates() + self.practice_suites.get_duplicates()
+        for (id_name, used_filename, ignored_filename) in duplicates:
+            self.write_warning_log("Duplicate id " + id_name + " in " + ignored_filename + " is ignored. (Defined in " + used_filename + ")")
 
-    def write_log(self, message):
-        print(message)
-        self.log_file.write(message + "\n")
+    def write_image_cache_log(self):
+        hits = self.image_cache.get_hits()
+        misses = self.image_cache.get_misses()
+        self.write_info_log("Image cache : hits=" + str(hits) + ", misses=" + str(misses) + ", bytes=" + str(self.image_cache.get_bytes()))
+
+    def write_reaction_times_log(self):
+        for (suite_id, histogram) in sorted(self.reaction_times.get_suite_histograms().items()):
+            self.write_info_log("Reaction times in Suite(" + suite_id + ") : " + str(histogram))
 
     def finalize(self):
+        if (self.current_suite is not None) and self.current_suite.is_adaptive():
+            try:
+                self.current_suite.save_schedule(self.get_schedule_filename())
+            except OSError as exception:   # Devices and the logger must still be closed.
+                self.write_error_log("Schedule not saved : " + str(exception))
+        if self.logger is not None:
+            self.write_image_cache_log()
+            self.write_reaction_times_log()
+        if self.midi_input_reader is not None:
+            self.midi_input_reader.stop()
         if self.midi_input_device is not None:
             self.midi_input_device.close()
         if self.midi_output_device is not None:
             self.midi_output_device.close()
         pygame.midi.quit()
         pygame.quit()
-        if (self.log_file is not None) and (self.log_file.closed is False):
-            self.log_file.close()
+        if self.logger is not None:
+            self.logger.stop()
+            self.logger = None
 
 
 class Properties(object):
 
+    STRING_KEYS = ("DirectoryForCases", "DirectoryForSuites", "DirectoryForSchedules", "CatalogFormat", "WindowTitle", "PreloadImages", "ScaleSmoothly",
+                   "LogLevel", "LogFormat", "UseTextureAtlas", "TextureAtlas", "TextureAtlasIndex",
+                   "NoteImage", "NoteImageAsAnswer", "HeadImage", "SpeakerImage", "SpeakerImageAsAnswer",
+                   "LineImage_Base")
+    INTEGER_KEYS = ("WindowWidth", "WindowHeight", "IntervalTime", "MidiPollInterval",
+                    "MidiIdlePollInterval", "MidiActiveWindow",
+                    "ImageCacheBytes", "StaffCacheBytes", "ScaledCanvasCacheBytes",
+                    "LineWidth", "AdditionalLinesWidth", "NoteOffsetX", "AdditionalLinesOffsetX", "SoundVelocity",
+                    "LogMaxBytes", "LogBackupCount", "LogQueueSize", "LogBatchSize")
+    FLOAT_KEYS = ("DisplayScale",)
+    CHOICE_KEYS = {"CatalogFormat": ("objects", "columnar"), "LogFormat": ("text", "json"),
+                   "PreloadImages": ("True", "False"), "ScaleSmoothly": ("True", "False"),
+                   "UseTextureAtlas": ("True", "False")}   # LogLevel is checked against Logger.LEVELS.
+
     def __init__(self, xml_filename):
         self.tree = xml.etree.ElementTree.parse(xml_filename)
         self.dictionary = dict()
         for element in self.tree.findall(".//property"):
             self.dictionary[element.get("key")] = element.get("value")
+        self.compile()
+
+    def compile(self):
+        self.integers = dict()
+        self.floats = dict()
+        key_image_keys = tuple("KeyImage_" + key for key in CaseGenerator.KEYS)
+        for key in Properties.STRING_KEYS + Layout.LINE_KEYS + key_image_keys:
+            self.get_required(key)
+        for key in Properties.INTEGER_KEYS:
+            self.integers[key] = self.parse_required(key, int)
+        for key in Properties.FLOAT_KEYS:
+            self.floats[key] = self.parse_required(key, float)
+        for key in list(Properties.CHOICE_KEYS.keys()) + ["LogLevel"]:
+            self.check_choice(key)
+        self.seed = self.parse_seed()
+        self.layout = Layout(self.dictionary)
+
+    def compile_key(self, key):   # Only the typed value of the key, so nothing else is rebuilt.
+        if key in Properties.INTEGER_KEYS:
+            self.integers[key] = self.parse_required(key, int)
+        elif key in Properties.FLOAT_KEYS:
+            self.floats[key] = self.parse_required(key, float)
+        elif (key in Properties.CHOICE_KEYS) or (key == "LogLevel"):
+            self.check_choice(key)
+        elif key == "RandomSeed":
+            self.seed = self.parse_seed()
+        elif Layout.is_layout_key(key):
+            self.layout.update(key, self.dictionary[key])
+
+    def check_choice(self, key):
+        choices = tuple(Logger.LEVELS.keys()) if key == "LogLevel" else Properties.CHOICE_KEYS[key]
+        value = self.get_required(key)
+        if value not in choices:
+            raise InvalidPropertiesException("Malformed property : " + key + "=" + value + " (one of " + ", ".join(choices) + ")")
+
+    def parse_seed(self):
+        if self.dictionary.get("RandomSeed", "") == "":
+            return None
+        return self.parse_required("RandomSeed", int)
+
+    def get_required(self, key):
+        if key not in self.dictionary:
+            raise InvalidPropertiesException("Missing property : " + key)
+        return self.dictionary[key]
+
+    def parse_required(self, key, parse):
+        value = self.get_required(key)
+        try:
+            return parse(value)
+        except ValueError:
+            raise InvalidPropertiesException("Malformed property : " + key + "=" + value)
 
     def get_by_key(self, key):
         return self.dictionary[key]
 
     def set_by_key(self, key, value):
+        previous_value = self.dictionary.get(key)
         self.dictionary[key] = value
+        try:
+            self.compile_key(key)
+        except InvalidPropertiesException:
+            if previous_value is None:
+                del self.dictionary[key]
+            else:
+                self.dictionary[key] = previous_value
+            raise
+
+    def get_int(self, key):
+        return self.integers[key]
+
+    def get_float(self, key):
+        return self.floats[key]
+
+    def get_layout(self):
+        return self.layout
+
+    def get_seed(self):
+        return self.seed
 
     def get(self, key):
         return self.get_by_key(key)
@@ -446,112 +665,1270 @@ class Properties(object):
     def set(self, key, value):
         self.set_by_key(key, value)
 
+    def get_image_filenames(self):
+        is_image_key = lambda key: re.match("^[A-Za-z]+Image(AsAnswer)?(_.+)?$", key) is not None
+        return [value for (key, value) in self.dictionary.items() if is_image_key(key)]
+
+
+class Layout(object):
+
+    LETTERS = "CDEFGAB"
+    ACCIDENTALS = ("", "s", "f")
+    STEPS = (None, "Upper", "Lower")
+    NUMBER_OF_ROWS = 7 * 10   # Diatonic rows from C0 to B9.
+    REQUIRED_POSITIONS = (("B6", None), ("G6", None), ("E6", None), ("C6", None), ("A5", None),
+                          ("C4", "Upper"), ("A3", "Upper"), ("G3", "Upper"),
+                          ("F4", "Lower"), ("E4", "Lower"), ("C4", "Lower"),
+                          ("E2", None), ("C2", None), ("A1", None), ("F1", None), ("D1", None))
+    LINE_KEYS = ("LineImage_Upper_Top5th", "LineImage_Upper_Top4th", "LineImage_Upper_Top3rd",
+                 "LineImage_Upper_Top2nd", "LineImage_Upper_Top1st", "LineImage_Upper_Bottom1st",
+                 "LineImage_Upper_Bottom2nd", "LineImage_Lower_Top2nd", "LineImage_Lower_Top1st",
+                 "LineImage_Lower_Bottom1st", "LineImage_Lower_Bottom2nd", "LineImage_Lower_Bottom3rd",
+                 "LineImage_Lower_Bottom4th", "LineImage_Lower_Bottom5th")   # Bit i of a line mask is LINE_KEYS[i].
+
+    def __init__(self, dictionary):
+        self.note_positions_y = array.array("i", [-1] * (len(Layout.STEPS) * Layout.NUMBER_OF_ROWS))
+        self.note_numbers = array.array("i", [-1] * (Layout.NUMBER_OF_ROWS * len(Layout.ACCIDENTALS)))
+        for (key, value) in dictionary.items():
+            if key.startswith("NotePositionY_"):
+                self.compile_note_position_y(key, value)
+            elif key.startswith("NoteNumber_"):
+                self.compile_note_number(key, value)
+        self.compile_line_masks()
+
+    @staticmethod
+    def is_layout_key(key):
+        return key.startswith("NotePositionY_") or key.startswith("NoteNumber_")
+
+    def update(self, key, value):   # In place, so every holder of this layout sees the change.
+        if key.startswith("NotePositionY_"):
+            self.compile_note_position_y(key, value)
+            self.compile_line_masks()
+        elif key.startswith("NoteNumber_"):
+            self.compile_note_number(key, value)
+
+    def compile_line_masks(self):
+        for (position_name, step) in Layout.REQUIRED_POSITIONS:
+            if self.note_positions_y[Layout.get_position_index(position_name, step)] < 0:
+                raise InvalidPropertiesException("Missing property : " + Layout.get_position_key(position_name, step))
+        self.max_note_position_y = max(self.note_positions_y)
+        self.line_masks = array.array("I", [0] * len(self.note_positions_y))
+        for (step_index, step) in enumerate(Layout.STEPS):
+            for row in range(Layout.NUMBER_OF_ROWS):
+                index = step_index * Layout.NUMBER_OF_ROWS + row
+                if self.note_positions_y[index] >= 0:
+                    self.line_masks[index] = self.compute_line_mask(self.note_positions_y[index], step)
+
+    def compile_note_position_y(self, key, value):
+        parts = key.split("_")
+        try:
+            step = parts[2] if len(parts) == 3 else None
+            if len(parts) > 3 or step not in Layout.STEPS:
+                raise ValueError
+            self.note_positions_y[Layout.get_position_index(parts[1], step)] = int(value)
+        except (ValueError, IndexError):
+            raise InvalidPropertiesException("Malformed property : " + key + "=" + value)
+
+    def compile_note_number(self, key, value):
+        try:
+            self.note_numbers[Layout.get_pitch_index(key[len("NoteNumber_"):])] = int(value)
+        except (ValueError, IndexError):
+            raise InvalidPropertiesException("Malformed property : " + key + "=" + value)
+
+    def compute_line_mask(self, note_y, step):
+        line_mask = 0
+        if note_y <= self.get_note_position_y("B6"):
+            line_mask = line_mask | Layout.get_line_bit("LineImage_Upper_Top5th")
+        if note_y <= self.get_note_position_y("G6"):
+            line_mask = line_mask | Layout.get_line_bit("LineImage_Upper_Top4th")
+        if note_y <= self.get_note_position_y("E6"):
+            line_mask = line_mask | Layout.get_line_bit("LineImage_Upper_Top3rd")
+        if note_y <= self.get_note_position_y("C6"):
+            line_mask = line_mask | Layout.get_line_bit("LineImage_Upper_Top2nd")
+        if note_y <= self.get_note_position_y("A5"):
+            line_mask = line_mask | Layout.get_line_bit("LineImage_Upper_Top1st")
+        if (step in (None, "Upper") and
+            note_y >= self.get_note_position_y("C4", "Upper") and
+            note_y <= self.get_note_position_y("G3", "Upper")):
+            line_mask = line_mask | Layout.get_line_bit("LineImage_Upper_Bottom1st")
+        if (step in (None, "Upper") and
+            note_y >= self.get_note_position_y("A3", "Upper") and
+            note_y <= self.get_note_position_y("G3", "Upper")):
+            line_mask = line_mask | Layout.get_line_bit("LineImage_Upper_Bottom2nd")
+        if (step == "Lower" and
+            note_y >= self.get_note_position_y("F4", "Lower") and
+            note_y <= self.get_note_position_y("E4", "Lower")):
+            line_mask = line_mask | Layout.get_line_bit("LineImage_Lower_Top2nd")
+        if (step == "Lower" and
+            note_y >= self.get_note_position_y("F4", "Lower") and
+            note_y <= self.get_note_position_y("C4", "Lower")):
+            line_mask = line_mask | Layout.get_line_bit("LineImage_Lower_Top1st")
+        if note_y >= self.get_note_position_y("E2"):
+            line_mask = line_mask | Layout.get_line_bit("LineImage_Lower_Bottom1st")
+        if note_y >= self.get_note_position_y("C2"):
+            line_mask = line_mask | Layout.get_line_bit("LineImage_Lower_Bottom2nd")
+        if note_y >= self.get_note_position_y("A1"):
+            line_mask = line_mask | Layout.get_line_bit("LineImage_Lower_Bottom3rd")
+        if note_y >= self.get_note_position_y("F1"):
+            line_mask = line_mask | Layout.get_line_bit("LineImage_Lower_Bottom4th")
+        if note_y >= self.get_note_position_y("D1"):
+            line_mask = line_mask | Layout.get_line_bit("LineImage_Lower_Bottom5th")
+        return line_mask
+
+    def get_line_mask(self, position_name, step = None):
+        return self.line_masks[Layout.get_position_index(position_name, step)]
+
+    @staticmethod
+    def get_line_bit(line_key):
+        return 1 << Layout.LINE_KEYS.index(line_key)
+
+    @staticmethod
+    def get_line_keys(line_mask):
+        return tuple(line_key for (bit, line_key) in enumerate(Layout.LINE_KEYS) if line_mask & (1 << bit))
+
+    def get_line_mask_of(self, note):
+        self.get_note_position_y_of(note)   # Fails on notes without a position, like the other lookups.
+        return self.line_masks[note.get_position_index()]
+
+    def get_note_position_y_of(self, note):
+        position_index = note.get_position_index()
+        if (position_index < 0) or (self.note_positions_y[position_index] < 0):
+            raise KeyError(Layout.get_position_key(note.get_position_name(), note.get_step()))
+        return self.note_positions_y[position_index]
+
+    def get_max_note_position_y(self):
+        return self.max_note_position_y
+
+    def get_note_number_of(self, note):
+        pitch_index = note.get_pitch_index()
+        if (pitch_index < 0) or (self.note_numbers[pitch_index] < 0):
+            raise KeyError("NoteNumber_" + note.get_name())
+        return self.note_numbers[pitch_index]
+
+    def get_note_position_y(self, position_name, step = None):
+        note_y = self.note_positions_y[Layout.get_position_index(position_name, step)]
+        if note_y < 0:
+            raise KeyError(Layout.get_position_key(position_name, step))
+        return note_y
+
+    def get_note_number(self, name):
+        note_number = self.note_numbers[Layout.get_pitch_index(name)]
+        if note_number < 0:
+            raise KeyError("NoteNumber_" + name)
+        return note_number
+
+    @staticmethod
+    def get_row(position_name):
+        if len(position_name) != 2 or position_name[0] not in Layout.LETTERS:
+            raise ValueError(position_name)
+        return int(position_name[1]) * len(Layout.LETTERS) + Layout.LETTERS.index(position_name[0])
+
+    @staticmethod
+    def get_position_index(position_name, step):
+        return Layout.STEPS.index(step) * Layout.NUMBER_OF_ROWS + Layout.get_row(position_name)
+
+    @staticmethod
+    def get_position_key(position_name, step):
+        if step:
+            return "NotePositionY_" + position_name + "_" + step
+        return "NotePositionY_" + position_name
+
+    @staticmethod
+    def get_pitch_index(name):
+        row = Layout.get_row(name[0] + name[-1])
+        return row * len(Layout.ACCIDENTALS) + Layout.ACCIDENTALS.index(name[1:-1])
+
+
+class StaffCompositor(object):
+
+    COLOR_WHITE = (255, 255, 255)
+
+    def __init__(self, props, get_image, max_bytes):
+        self.props = props
+        self.get_image = get_image
+        self.staff_images = SurfaceCache(max_bytes)
+        self.additional_lines_images = dict()   # Keyed by line mask and width.
+
+    def get_staff_image(self, key, line_mask, is_wide = False):
+        return self.staff_images.get((key, line_mask, is_wide), self.create_staff_image)
+
+    def get_staff_size(self, key):
+        head_image = self.get_image(self.props.get("HeadImage"))
+        key_image  = self.get_image(self.props.get("KeyImage_" + key))
+        base_image = self.get_image(self.props.get("LineImage_Base"))
+        whole_width  = head_image.get_width() + key_image.get_width() + self.props.get_int("LineWidth")
+        whole_height = max(head_image.get_height(), key_image.get_height(), base_image.get_height())
+        return (whole_width, whole_height)
+
+    def get_notes_position_x(self, staff_width):
+        lines_position_x = staff_width - self.props.get_int("LineWidth")
+        return lines_position_x + self.props.get_int("NoteOffsetX")
+
+    def create_staff_image(self, staff_key):
+        (key, line_mask, is_wide) = staff_key
+        head_image  = self.get_image(self.props.get("HeadImage"))
+        key_image   = self.get_image(self.props.get("KeyImage_" + key))
+        lines_image = self.get_lines_image(line_mask, is_wide)
+        whole_width  = head_image.get_width() + key_image.get_width() + lines_image.get_width()
+        whole_height = max(head_image.get_height(), key_image.get_height(), lines_image.get_height())
+        staff_image = pygame.Surface((whole_width, whole_height))
+        staff_image.fill(StaffCompositor.COLOR_WHITE)
+        head_position_x  = 0
+        key_position_x   = head_position_x + head_image.get_width()
+        lines_position_x = key_position_x  + key_image.get_width()
+        staff_image.blit(head_image,  (head_position_x,  0))
+        staff_image.blit(key_image,   (key_position_x,   0))
+        staff_image.blit(lines_image, (lines_position_x, 0))
+        return staff_image
+
+    def get_lines_image(self, line_mask, is_wide = False):
+        base_image = self.get_image(self.props.get("LineImage_Base"))
+        scaled_width = self.props.get_int("LineWidth")
+        scaled_height = base_image.get_height()
+        scaled_image = pygame.transform.scale(base_image, (scaled_width, scaled_height))
+        additional_lines_image = self.get_additional_lines_image(line_mask, is_wide)
+        if additional_lines_image is not None:
+            additional_lines_offset_x = self.props.get_int("AdditionalLinesOffsetX")
+            scaled_image.blit(additional_lines_image, (additional_lines_offset_x, 0))
+        return scaled_image
+
+    def get_additional_lines_image(self, line_mask, is_wide = False):
+        if line_mask == 0:
+            return None
+        if (line_mask, is_wide) not in self.additional_lines_images:
+            self.additional_lines_images[(line_mask, is_wide)] = self.create_additional_lines_image(line_mask, is_wide)
+        return self.additional_lines_images[(line_mask, is_wide)]
+
+    def create_additional_lines_image(self, line_mask, is_wide = False):
+        line_keys = Layout.get_line_keys(line_mask)
+        base_image = self.get_image(self.props.get(line_keys[0])).copy()   # Cached surfaces must not be modified.
+        for line_key in line_keys[1:]:
+            base_image.blit(self.get_image(self.props.get(line_key)), (0, 0))
+        scaled_width = self.props.get_int("AdditionalLinesWidth")
+        if is_wide:   # One more note width for the upper note of a second
+            scaled_width = scaled_width + self.get_image(self.props.get("NoteImage")).get_width()
+        scaled_height = base_image.get_height()
+        return pygame.transform.scale(base_image, (scaled_width, scaled_height))
+
+
+class TextureAtlas(object):
+
+    VERSION = 2
+    WIDTH_STEP = 64   # Granularity of the atlas widths tried while packing
+
+    def __init__(self, image_filename, index_filename):
+        with open(index_filename, "r", encoding = "utf-8") as index_file:
+            index = json.load(index_file)
+        if index.get("version") != TextureAtlas.VERSION:
+            raise ValueError("Unsupported texture atlas : " + index_filename)
+        self.image = pygame.image.load(image_filename).convert_alpha()   # One decode in the display format
+        self.surfaces = dict()
+        for (filename, (x, y, width, height, digest)) in index["images"].items():
+            try:
+                if TextureAtlas.get_digest(filename) != digest:   # Edited since the atlas was built. Load it by itself.
+                    continue
+            except OSError:
+                pass   # Only the atlas was shipped.
+            self.surfaces[filename] = self.image.subsurface((x, y, width, height))
+
+    @staticmethod
+    def get_digest(filename):
+        with open(filename, "rb") as image_file:
+            return hashlib.sha1(image_file.read()).hexdigest()
+
+    def get(self, filename):
+        return self.surfaces.get(os.path.normpath(filename))
+
+    @staticmethod
+    def build(filenames, image_filename, index_filename):
+        images = dict((os.path.normpath(filename), pygame.image.load(filename)) for filename in filenames)
+        sizes = [(filename, images[filename].get_size()) for filename in images.keys()]
+        sizes.sort(key = lambda item: (-item[1][1], -item[1][0], item[0]))
+        widest = max(width for (filename, (width, height)) in sizes)
+        total_width = sum(width for (filename, (width, height)) in sizes)
+        candidates = (TextureAtlas.pack(sizes, width) for width in range(widest, total_width + TextureAtlas.WIDTH_STEP, TextureAtlas.WIDTH_STEP))
+        (atlas_width, atlas_height, rects) = min(candidates, key = lambda candidate: candidate[0] * candidate[1])
+        atlas = pygame.Surface((atlas_width, atlas_height), pygame.SRCALPHA, 32)
+        atlas.fill((0, 0, 0, 0))
+        for (filename, rect) in rects.items():
+            atlas.blit(images[filename], rect[:2], special_flags = pygame.BLEND_RGBA_MAX)   # Copy pixels exactly.
+        pygame.image.save(atlas, image_filename)
+        entries = ["  " + json.dumps(filename) + ": " + json.dumps(list(rect) + [TextureAtlas.get_digest(filename)])
+                   for (filename, rect) in sorted(rects.items())]   # x, y, width, height, SHA-1 of the source file
+        with open(index_filename, "w", encoding = "utf-8") as index_file:
+            index_file.write('{"version": ' + str(TextureAtlas.VERSION) + ', "images": {\n' + ",\n".join(entries) + "\n}}\n")
+
+    @staticmethod
+    def pack(sizes, atlas_width):
+        rects = dict()
+        (x, y, shelf_height, used_width) = (0, 0, 0, 0)
+        for (filename, (width, height)) in sizes:   # Shelf packing: images of similar height share a row.
+            if x + width > atlas_width:
+                (x, y, shelf_height) = (0, y + shelf_height, 0)
+            rects[filename] = (x, y, width, height)
+            x = x + width
+            shelf_height = max(shelf_height, height)
+            used_width = max(used_width, x)
+        return (used_width, y + shelf_height, rects)
+
+
+class SurfaceCache(object):
+
+    def __init__(self, max_bytes):
+        self.surfaces = collections.OrderedDict()   # Ordered from least to most recently used.
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, create):
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+            self.hits = self.hits + 1
+            return surface
+        self.misses = self.misses + 1
+        surface = create(key)
+        self.put(key, surface)
+        return surface
+
+    def put(self, key, surface):
+        if key in self.surfaces:
+            self.bytes = self.bytes - self.get_size(self.surfaces.pop(key))
+        self.surfaces[key] = surface
+        self.bytes = self.bytes + self.get_size(surface)
+        while self.bytes > self.max_bytes and len(self.surfaces) > 1:
+            (evicted_key, evicted_surface) = self.surfaces.popitem(last = False)
+            self.bytes = self.bytes - self.get_size(evicted_surface)
+
+    def get_size(self, surface):
+        return surface.get_pitch() * surface.get_height()
+
+    def clear(self):
+        self.surfaces.clear()
+        self.bytes = 0
+
+    def get_hits(self):
+        return self.hits
+
+    def get_misses(self):
+        return self.misses
+
+    def get_bytes(self):
+        return self.bytes
+
+
+class Catalog(object):
+
+    VERSION = 8
+    FILENAME = ".catalog"
+    PARALLEL_THRESHOLD = 4   # Parse in worker processes when at least this many files changed.
+
+    def __init__(self, directory, parse_file, get_id):
+        self.filename = os.path.join(directory, Catalog.FILENAME)
+        self.parse_file = parse_file
+        self.body_offset = 0   # Records of each file follow the header line, read only when asked for.
+        cached_entries = self.load()
+        self.entries = dict()   # xml_filename -> (mtime_ns, size, ids, offset, length) in the catalog file
+        self.texts = dict()     # xml_filename -> records as JSON bytes, parsed in this run and not saved yet
+        changed_files = list()
+        for xml_file in sorted(org.fukurous.utils.filesystem.filelist_with_pattern(directory, "**/*.xml")):
+            xml_filename = str(xml_file)
+            stat = xml_file.stat()
+            entry = cached_entries.get(xml_filename)
+            if (entry is None) or (entry[0] != stat.st_mtime_ns) or (entry[1] != stat.st_size):
+                changed_files.append((xml_filename, stat))
+            else:
+                self.entries[xml_filename] = entry
+        xml_filenames = [xml_filename for (xml_filename, stat) in changed_files]
+        for ((xml_filename, stat), records) in zip(changed_files, self.parse_files(parse_file, xml_filenames)):
+            ids = tuple(get_id(record) for record in records)
+            self.entries[xml_filename] = (stat.st_mtime_ns, stat.st_size, ids, 0, 0)
+            self.texts[xml_filename] = json.dumps(records, separators = (",", ":")).encode("utf-8")
+        if (len(changed_files) > 0) or (len(cached_entries) != len(self.entries)):
+            self.save()
+        self.create_index()
+
+    def parse_files(self, parse_file, xml_filenames):
+        number_of_workers = min(os.cpu_count() or 1, len(xml_filenames))
+        if len(xml_filenames) >= Catalog.PARALLEL_THRESHOLD and number_of_workers > 1:
+            try:
+                with concurrent.futures.ProcessPoolExecutor(number_of_workers) as executor:
+                    chunksize = max(1, len(xml_filenames) // (4 * number_of_workers))
+                    return list(executor.map(parse_file, xml_filenames, chunksize = chunksize))   # Keeps input order.
+            except (OSError, concurrent.futures.process.BrokenProcessPool):
+                pass   # Processes are not available here. Parse in this process.
+        return [parse_file(xml_filename) for xml_filename in xml_filenames]
+
+    def create_index(self):
+        self.index = dict()        # id -> (xml_filename, position)
+        self.duplicates = list()   # (id, xml_filename used, xml_filename ignored)
+        for xml_filename in sorted(self.entries.keys()):
+            for (position, id_name) in enumerate(self.entries[xml_filename][2]):
+                if id_name in self.index:
+                    self.duplicates.append((id_name, self.index[id_name][0], xml_filename))
+                else:
+                    self.index[id_name] = (xml_filename, position)
+
+    def load(self):   # Plain JSON, never pickle: catalogs may come with case packs from others.
+        try:
+            with open(self.filename, "rb") as catalog_file:
+                header = catalog_file.readline()   # Only the ids. Records stay on disk.
+            catalog = json.loads(header)
+            if catalog["version"] == Catalog.VERSION:
+                self.body_offset = len(header)
+                return dict((xml_filename, (mtime_ns, size, tuple(ids), offset, length))
+                            for (xml_filename, (mtime_ns, size, ids, offset, length)) in catalog["entries"].items())
+        except (OSError, ValueError, TypeError, KeyError):
+            pass   # Missing or broken catalog. Rebuild it.
+        return dict()
+
+    def save(self):
+        temporary_filename = self.filename + ".tmp"
+        entries = dict()
+        texts = list()
+        offset = 0
+        try:
+            for xml_filename in sorted(self.entries.keys()):
+                text = self.read_text(xml_filename)
+                entries[xml_filename] = self.entries[xml_filename][:3] + (offset, len(text))
+                texts.append(text)
+                offset = offset + len(text)
+            header = json.dumps({"version": Catalog.VERSION, "entries": entries}, separators = (",", ":")).encode("utf-8") + b"\n"
+            with open(temporary_filename, "wb") as catalog_file:
+                catalog_file.write(header)
+                for text in texts:
+                    catalog_file.write(text)
+            os.replace(temporary_filename, self.filename)
+        except OSError:
+            return   # Read-only directory. Keep the parsed records in memory and parse again on next startup.
+        self.entries = entries
+        self.body_offset = len(header)
+        self.texts.clear()
+
+    def read_text(self, xml_filename):
+        if xml_filename in self.texts:
+            return self.texts[xml_filename]
+        (mtime_ns, size, ids, offset, length) = self.entries[xml_filename]
+        with open(self.filename, "rb") as catalog_file:
+            catalog_file.seek(self.body_offset + offset)
+            text = catalog_file.read(length)
+        if len(text) != length:
+            raise ValueError("Truncated catalog : " + self.filename)
+        return text
+
+    @staticmethod
+    def to_tuples(value):   # JSON has no tuples. Records are nested tuples.
+        if isinstance(value, list):
+            return tuple(Catalog.to_tuples(item) for item in value)
+        return value
+
+    @staticmethod
+    def iterate_elements(xml_filename, tag):
+        parents = list()
+        for (event, element) in xml.etree.ElementTree.iterparse(xml_filename, events = ("start", "end")):
+            if event == "start":
+                parents.append(element)
+                continue
+            parents.pop()
+            if element.tag == tag:
+                yield element
+                element.clear()   # Drop the parsed element so memory does not grow with the file.
+                if len(parents) > 0:
+                    parents[-1].remove(element)
+
+    def get_index(self):
+        return self.index
+
+    def get_duplicates(self):
+        return self.duplicates
+
+    def get_records_in(self, xml_filename):
+        try:
+            return Catalog.to_tuples(json.loads(self.read_text(xml_filename)))
+        except (OSError, ValueError):   # Catalog changed under us. The XML file itself is still current.
+            return self.parse_file(xml_filename)
+
+    def get_records(self):
+        for xml_filename in sorted(self.entries.keys()):
+            for (position, record) in enumerate(self.get_records_in(xml_filename)):
+                if self.index[self.entries[xml_filename][2][position]] == (xml_filename, position):
+                    yield record
+
 
 class PracticeSuites(object):
 
-    def __init__(self, directory):
+    def __init__(self, directory, seed = None, case_index = None, case_generator = None, practice_cases = None):
         self.suites = dict()
-        for xml_file in org.fukurous.utils.filesystem.filelist_with_pattern(directory, "**/*.xml"):
-            xml_filename = str(xml_file)
-            self.tree = xml.etree.ElementTree.parse(xml_filename)
-            for suite_node in self.tree.findall(".//suite"):
-                self.suites[suite_node.get("id")] = PracticeSuite(suite_node)
+        self.deferred_records = dict()   # Suites with queries, generators or transpositions are resolved on first use.
+        self.empty_ids = set()   # Suites found to have no case to choose
+        self.untransposed = dict()   # Suite id -> [(case id, keys it could not be transposed into)]
+        self.seed = seed
+        self.case_index = case_index
+        self.case_generator = case_generator
+        self.practice_cases = practice_cases   # Source of the notes of transposed cases
+        self.catalog = Catalog(directory, PracticeSuites.parse_file, PracticeSuites.get_record_id)
+        for (id_name, rates, mode, queries, generators, keys) in self.catalog.get_records():
+            if (len(queries) > 0) or (len(generators) > 0) or (len(keys) > 0) or not PracticeSuites.has_cases(rates):
+                self.deferred_records[id_name] = (rates, mode, queries, generators, keys)
+            else:
+                self.suites[id_name] = PracticeSuite(id_name, rates, mode, seed)
+
+    @staticmethod
+    def get_record_id(record):
+        return record[0]
+
+    def get_duplicates(self):
+        return self.catalog.get_duplicates()
+
+    @staticmethod
+    def parse_file(xml_filename):
+        records = list()
+        for suite_node in Catalog.iterate_elements(xml_filename, "suite"):
+            rates = tuple((element.get("id"), int(element.get("rate"))) for element in suite_node.findall(".//case"))
+            queries = tuple((int(element.get("rate")),
+                             tuple((name, element.get(name)) for name in CaseIndex.CRITERIA if element.get(name) is not None))
+                            for element in suite_node.findall(".//query"))
+            generators = tuple((int(element.get("rate")),
+                                tuple((name, element.get(name)) for name in CaseGenerator.PARAMETERS if element.get(name) is not None))
+                               for element in suite_node.findall(".//generate"))
+            keys = tuple(suite_node.get("transpose", "").split())
+            if keys == ("all",):
+                keys = CaseGenerator.KEYS
+            records.append((suite_node.get("id"), rates, suite_node.get("mode", PracticeSuite.MODE_RANDOM), queries, generators, keys))
+        return records
+
+    @staticmethod
+    def has_cases(rates):
+        return any(rate > 0 for (case_id, rate) in rates)
 
     def get_by_id(self, id_name):
+        if id_name in self.empty_ids:
+            raise EmptySuiteException("No case to choose in Suite(" + id_name + ")")
+        if id_name in self.deferred_records:
+            (rates, mode, queries, generators, keys) = self.deferred_records.pop(id_name)
+            rates = list(rates)
+            listed_ids = set(case_id for (case_id, rate) in rates)
+            def add(case_ids, rate):
+                for case_id in case_ids:
+                    if case_id not in listed_ids:   # Cases listed by hand or by an earlier element keep their rate.
+                        listed_ids.add(case_id)
+                        rates.append((case_id, rate))
+            for (rate, criteria) in queries:
+                add(self.case_index.resolve(dict(criteria)), rate)
+            for (rate, parameters) in generators:
+                add(self.case_generator.generate_ids(**dict(parameters)), rate)
+            untransposed = list()
+            for (case_id, rate) in (list(rates) if len(keys) > 0 else list()):
+                record = self.practice_cases.get_record(case_id)
+                if record is None:
+                    untransposed.append((case_id, keys))
+                    continue
+                (transposed_ids, failed_keys) = self.case_generator.transpose_record_into_keys(record, keys)
+                add(transposed_ids, rate)
+                if len(failed_keys) > 0:
+                    untransposed.append((case_id, failed_keys))
+            self.untransposed[id_name] = untransposed
+            if not PracticeSuites.has_cases(rates):
+                self.empty_ids.add(id_name)
+                raise EmptySuiteException("No case to choose in Suite(" + id_name + ")")
+            self.suites[id_name] = PracticeSuite(id_name, rates, mode, self.seed)
         return self.suites[id_name]
 
     def get_list(self):
-        return sorted(list(self.suites.keys()))
+        return sorted(list(self.suites.keys()) + list(self.deferred_records.keys()))   # Empty suites are left out.
+
+    def get_untransposed(self, id_name):
+        return self.untransposed.get(id_name, list())
 
 
 class PracticeSuite(object):
 
-    def __init__(self, suite_node, randomly = True):
+    MODE_RANDOM = "random"
+    MODE_SEQUENTIAL = "sequential"
+    MODE_SHUFFLE = "shuffle"   # Every case once, in weighted random order, before any repeats
+    MODE_ADAPTIVE = "adaptive"   # Spaced repetition driven by correctness and reaction time
+
+    def __init__(self, id_name, rates, mode = MODE_RANDOM, seed = None):
         self.dictionary = dict()
-        self.total_rate = 0
-        self.id = suite_node.get("id")
-        for element in suite_node.findall(".//case"):
-            rate = int(element.get("rate"))
-            self.dictionary[element.get("id")] = rate
-        for key in self.dictionary.keys():
-            self.total_rate = self.total_rate + self.dictionary[key]
+        self.id = id_name
+        for (case_id, rate) in rates:
+            self.dictionary[case_id] = rate
         self.current_index = -1
-        self.randomly = randomly
+        self.mode = mode
+        self.random = random.Random(seed)
+        self.ids = list(self.dictionary.keys())
+        self.sampler = AliasSampler(list(self.dictionary.values()))
+        self.bag = list()
+        self.bag_position = 0
+        self.scheduler = None
+        if mode == PracticeSuite.MODE_ADAPTIVE:   # Like the other weighted modes, cases with rate="0" are never served.
+            self.scheduler = RepetitionScheduler([case_id for case_id in self.ids if self.dictionary[case_id] > 0])
 
     def get_id(self):
         return self.id
 
+    def get_case_ids(self):
+        return list(self.dictionary.keys())
+
     def choose_one_id(self):
-        if self.randomly:
-            return self.choose_one_id_randomly()
-        else:
+        if self.mode == PracticeSuite.MODE_ADAPTIVE:
+            return self.scheduler.choose_one_id()
+        elif self.mode == PracticeSuite.MODE_SHUFFLE:
+            return self.choose_one_id_from_bag()
+        elif self.mode == PracticeSuite.MODE_SEQUENTIAL:
             return self.choose_one_id_sequentially()
+        else:
+            return self.choose_one_id_randomly()
 
     def choose_one_id_randomly(self):
-        random_number = random.randint(1, self.total_rate)
-        threshold = 0
-        for key in self.dictionary.keys():
-            threshold = threshold + self.dictionary[key]
-            if threshold >= random_number:
-                break
-        chosen_id = key
-        return chosen_id
+        return self.ids[self.sampler.sample(self.random)]
+
+    def is_adaptive(self):
+        return self.scheduler is not None
+
+    def record_answer(self, case_id, wrong_answers, reaction_time):
+        if self.scheduler is not None:
+            self.scheduler.record_answer(case_id, wrong_answers, reaction_time)
+
+    def load_schedule(self, filename):
+        self.scheduler.load(filename)
+
+    def save_schedule(self, filename):
+        self.scheduler.save(filename)
 
     def choose_one_id_sequentially(self):
         self.current_index = self.current_index + 1
-        if self.current_index >= len(self.dictionary):
+        if self.current_index >= len(self.ids):
             self.current_index = 0
-        return list(self.dictionary.keys())[self.current_index]
+        return self.ids[self.current_index]
+
+    def choose_one_id_from_bag(self):
+        if self.bag_position >= len(self.bag):
+            previous_id = self.bag[-1] if len(self.bag) > 0 else None
+            self.fill_bag()
+            if (len(self.bag) > 1) and (self.bag[0] == previous_id):   # No repeat across bags either.
+                (self.bag[0], self.bag[1]) = (self.bag[1], self.bag[0])
+        chosen_id = self.bag[self.bag_position]
+        self.bag_position = self.bag_position + 1
+        return chosen_id
+
+    def fill_bag(self):
+        rates = set(self.dictionary.values())
+        if len(rates) == 1:
+            self.bag = list(self.ids)
+            self.random.shuffle(self.bag)
+        else:   # Weighted random order (Efraimidis-Spirakis): heavier cases tend to come first.
+            sort_key = lambda case_id: self.random.random() ** (1.0 / self.dictionary[case_id])
+            self.bag = sorted((case_id for case_id in self.ids if self.dictionary[case_id] > 0), key = sort_key, reverse = True)
+        self.bag_position = 0
+
+
+class RepetitionScheduler(object):
+
+    INITIAL_INTERVAL = 60.0        # Seconds until a newly learned case is due again
+    INITIAL_EASE = 2.5
+    MINIMUM_EASE = 1.3
+    TARGET_REACTION_TIME = 2000000   # Microseconds. Slower answers count as hesitant.
+    RECORD_HEADER = struct.Struct("<H")
+    RECORD_BODY = struct.Struct("<dfHf")   # due, interval, repetitions, ease
+
+    def __init__(self, ids):
+        self.states = dict()   # id -> [due, interval, repetitions, ease]
+        self.heap = list()     # (due, sequence, id) with stale entries skipped lazily
+        self.sequences = dict()   # id -> sequence of its live heap entry
+        self.sequence = 0
+        for case_id in ids:
+            self.states[case_id] = [0.0, 0.0, 0, RepetitionScheduler.INITIAL_EASE]
+            self.push(case_id)
+
+    def push(self, case_id):
+        self.sequence = self.sequence + 1
+        self.sequences[case_id] = self.sequence
+        heapq.heappush(self.heap, (self.states[case_id][0], self.sequence, case_id))
+        if len(self.heap) > 2 * len(self.states):   # Too many stale entries. Compact.
+            self.heap = [entry for entry in self.heap if self.sequences[entry[2]] == entry[1]]
+            heapq.heapify(self.heap)
+
+    def choose_one_id(self):
+        while self.sequences[self.heap[0][2]] != self.heap[0][1]:
+            heapq.heappop(self.heap)
+        return self.heap[0][2]   # The earliest due case, even if nothing is due yet.
+
+    def record_answer(self, case_id, wrong_answers, reaction_time):
+        quality = RepetitionScheduler.get_quality(wrong_answers, reaction_time)
+        state = self.states[case_id]
+        (due, interval, repetitions, ease) = state
+        ease = max(RepetitionScheduler.MINIMUM_EASE, ease + 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02))
+        if quality < 3:
+            repetitions = 0
+            interval = RepetitionScheduler.INITIAL_INTERVAL
+        else:
+            repetitions = repetitions + 1
+            interval = RepetitionScheduler.INITIAL_INTERVAL if repetitions == 1 else interval * ease
+        state[:] = [time.time() + interval, interval, repetitions, ease]
+        self.push(case_id)
+
+    @staticmethod
+    def get_quality(wrong_answers, reaction_time):
+        if wrong_answers > 0:
+            return max(0, 3 - wrong_answers)
+        if reaction_time <= RepetitionScheduler.TARGET_REACTION_TIME:
+            return 5
+        if reaction_time <= 2 * RepetitionScheduler.TARGET_REACTION_TIME:
+            return 4
+        return 3
+
+    def load(self, filename):
+        try:
+            with open(filename, "rb") as schedule_file:
+                data = schedule_file.read()
+        except FileNotFoundError:
+            return
+        records = list()
+        offset = 0
+        try:   # Read everything first, so a broken file leaves the fresh schedule untouched.
+            while offset < len(data):
+                (length,) = RepetitionScheduler.RECORD_HEADER.unpack_from(data, offset)
+                offset = offset + RepetitionScheduler.RECORD_HEADER.size
+                if offset + length > len(data):
+                    raise ValueError("Truncated case id")
+                case_id = data[offset:offset + length].decode("utf-8")
+                offset = offset + length
+                records.append((case_id, RepetitionScheduler.RECORD_BODY.unpack_from(data, offset)))
+                offset = offset + RepetitionScheduler.RECORD_BODY.size
+        except (struct.error, UnicodeDecodeError, ValueError) as exception:
+            raise ValueError("Broken schedule " + filename + " : " + str(exception))
+        for (case_id, (due, interval, repetitions, ease)) in records:
+            if case_id in self.states:   # Cases removed from the suite are forgotten.
+                self.states[case_id][:] = [due, interval, repetitions, ease]
+                self.push(case_id)
+
+    def save(self, filename):
+        chunks = list()
+        for (case_id, (due, interval, repetitions, ease)) in self.states.items():
+            encoded_id = case_id.encode("utf-8")
+            chunks.append(RepetitionScheduler.RECORD_HEADER.pack(len(encoded_id)))
+            chunks.append(encoded_id)
+            chunks.append(RepetitionScheduler.RECORD_BODY.pack(due, interval, min(repetitions, 0xFFFF), ease))
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok = True)
+        temporary_filename = filename + ".tmp"
+        with open(temporary_filename, "wb") as schedule_file:
+            schedule_file.write(b"".join(chunks))
+        os.replace(temporary_filename, filename)
+
+
+class AliasSampler(object):
+
+    def __init__(self, weights):
+        size = len(weights)
+        total = sum(weights)
+        if total <= 0:
+            raise ValueError("Total weight must be positive")
+        self.probabilities = array.array("d", [1.0] * size)
+        self.aliases = array.array("L", range(size))
+        scaled_weights = [weight * size / total for weight in weights]
+        small = [index for (index, weight) in enumerate(scaled_weights) if weight < 1.0]
+        large = [index for (index, weight) in enumerate(scaled_weights) if weight >= 1.0]
+        while (len(small) > 0) and (len(large) > 0):
+            small_index = small.pop()
+            large_index = large.pop()
+            self.probabilities[small_index] = scaled_weights[small_index]
+            self.aliases[small_index] = large_index
+            scaled_weights[large_index] = scaled_weights[large_index] + scaled_weights[small_index] - 1.0
+            if scaled_weights[large_index] < 1.0:
+                small.append(large_index)
+            else:
+                large.append(large_index)
+
+    def sample(self, random_generator):
+        position = random_generator.random() * len(self.probabilities)
+        index = int(position)
+        if (position - index) < self.probabilities[index]:
+            return index
+        return self.aliases[index]
+
+
+class ColumnarCases(object):
+
+    FILENAME = ".columnar"
+    MAGIC = b"PPCOLUMN"
+    VERSION = 3
+    HEADER = struct.Struct("<8sI20sI")   # magic, version, signature of the XML files, number of sections
+    SECTION = struct.Struct("<QQ")       # offset, length
+    SECTION_FORMATS = (None, "I", None, "B", "H", "I", "H")   # Layout of the sections after the header
+
+    def __init__(self, buffer, signature):
+        self.buffer = buffer   # mmap or bytes. Keeps the memory behind the views alive.
+        view = memoryview(buffer)
+        (magic, version, file_signature, number_of_sections) = ColumnarCases.HEADER.unpack_from(view, 0)
+        if (magic != ColumnarCases.MAGIC) or (version != ColumnarCases.VERSION) or (file_signature != signature):
+            raise ValueError("Stale or foreign columnar catalog")
+        sections = list()
+        for (number, section_format) in enumerate(ColumnarCases.SECTION_FORMATS[:number_of_sections]):
+            position = ColumnarCases.HEADER.size + number * ColumnarCases.SECTION.size
+            (offset, length) = ColumnarCases.SECTION.unpack_from(view, position)
+            section = view[offset:offset + length]
+            sections.append(section.cast(section_format) if section_format else section)
+        (tables, self.id_offsets, self.ids, self.types, self.attributes, self.note_offsets, self.note_codes) = sections
+        (self.type_names, self.attribute_names, self.note_table, self.duplicates) = Catalog.to_tuples(json.loads(bytes(tables)))
+
+    @staticmethod
+    def open(directory, create_catalog):
+        filename = os.path.join(directory, ColumnarCases.FILENAME)
+        signature = ColumnarCases.get_signature(directory)
+        try:
+            with open(filename, "rb") as columnar_file:
+                return ColumnarCases(mmap.mmap(columnar_file.fileno(), 0, access = mmap.ACCESS_READ), signature)
+        except (OSError, ValueError, TypeError, struct.error):
+            pass   # Missing, stale or broken. Build it from the catalog.
+        catalog = create_catalog()
+        data = ColumnarCases.serialize(signature, catalog.get_records(), catalog.get_duplicates())
+        try:
+            with open(filename + ".tmp", "wb") as columnar_file:
+                columnar_file.write(data)
+            os.replace(filename + ".tmp", filename)
+            with open(filename, "rb") as columnar_file:
+                return ColumnarCases(mmap.mmap(columnar_file.fileno(), 0, access = mmap.ACCESS_READ), signature)
+        except OSError:
+            return ColumnarCases(data, signature)   # Read-only directory. Keep it in memory.
+
+    @staticmethod
+    def get_signature(directory):
+        digest = hashlib.sha1()
+        for xml_file in sorted(org.fukurous.utils.filesystem.filelist_with_pattern(directory, "**/*.xml")):
+            stat = xml_file.stat()
+            digest.update((str(xml_file) + "\0" + str(stat.st_mtime_ns) + "\0" + str(stat.st_size) + "\0").encode("utf-8"))
+        return digest.digest()
+
+    @staticmethod
+    def serialize(signature, records, duplicates):
+        records = sorted(records, key = lambda record: record[1].encode("utf-8"))
+        type_names = list()
+        attribute_names = list()
+        note_table = list()
+        codes = dict()   # (table, value) -> index into that table
+        def get_code(table, value):
+            key = (id(table), value)
+            if key not in codes:
+                codes[key] = len(table)
+                table.append(value)
+            return codes[key]
+        id_offsets = array.array("I", [0])
+        ids = bytearray()
+        types = array.array("B")
+        attributes = array.array("H")
+        note_offsets = array.array("I", [0])
+        note_codes = array.array("H")
+        for (type_name, id_name, attribute, notes) in records:
+            ids.extend(id_name.encode("utf-8"))
+            id_offsets.append(len(ids))
+            types.append(get_code(type_names, type_name))
+            attributes.append(get_code(attribute_names, attribute))
+            for note in notes:
+                note_codes.append(get_code(note_table, note))
+            note_offsets.append(len(note_codes))
+        tables = json.dumps([type_names, attribute_names, note_table, list(duplicates)]).encode("utf-8")
+        sections = [tables, id_offsets.tobytes(), bytes(ids), types.tobytes(), attributes.tobytes(),
+                    note_offsets.tobytes(), note_codes.tobytes()]
+        header_size = ColumnarCases.HEADER.size + len(sections) * ColumnarCases.SECTION.size
+        chunks = [ColumnarCases.HEADER.pack(ColumnarCases.MAGIC, ColumnarCases.VERSION, signature, len(sections))]
+        body = bytearray()
+        offset = header_size + (-header_size % 8)
+        for section in sections:
+            chunks.append(ColumnarCases.SECTION.pack(offset + len(body), len(section)))
+            body.extend(section)
+            body.extend(bytes(-len(body) % 8))   # Keep every section 8-byte aligned.
+        chunks.append(bytes(offset - header_size))
+        return b"".join(chunks) + bytes(body)
+
+    def get_id_at(self, position):
+        return bytes(self.ids[self.id_offsets[position]:self.id_offsets[position + 1]]).decode("utf-8")
+
+    def find(self, id_name):
+        target = id_name.encode("utf-8")
+        (low, high) = (0, len(self.types))
+        while low < high:
+            middle = (low + high) // 2
+            if bytes(self.ids[self.id_offsets[middle]:self.id_offsets[middle + 1]]) < target:
+                low = middle + 1
+            else:
+                high = middle
+        if (low < len(self.types)) and (self.get_id_at(low) == id_name):
+            return low
+        return -1
+
+    def contains(self, id_name):
+        return self.find(id_name) >= 0
+
+    def get_record(self, id_name):
+        position = self.find(id_name)
+        if position < 0:
+            raise KeyError(id_name)
+        return self.get_record_at(position)
+
+    def get_record_at(self, position):
+        notes = tuple(self.note_table[self.note_codes[index]]
+                      for index in range(self.note_offsets[position], self.note_offsets[position + 1]))
+        return (self.type_names[self.types[position]], self.get_id_at(position),
+                self.attribute_names[self.attributes[position]], notes)
+
+    def get_records(self):
+        return (self.get_record_at(position) for position in range(len(self.types)))
+
+    def get_ids(self):
+        return [self.get_id_at(position) for position in range(len(self.types))]
+
+    def get_duplicates(self):
+        return self.duplicates
 
 
 class PracticeCases(object):
 
-    def __init__(self, directory):
-        self.cases = dict()
-        for xml_file in org.fukurous.utils.filesystem.filelist_with_pattern(directory, "**/*.xml"):
-            xml_filename = str(xml_file)
-            self.tree = xml.etree.ElementTree.parse(xml_filename)
-            for case in self.tree.findall(".//case"):
-                type_name = case.get("type")
-                if type_name == "score":
-                    id_name = case.get("id")
-                    key = case.find("./score").get("key")
-                    notes = list()
-                    for note_node in case.findall("./notes/note"):
-                        note_name = note_node.get("name")
-                        note_step = note_node.get("step")
-                        if note_step:
-                            note = Note(note_name, note_step)
-                        else:
-                            note = Note(note_name)
-                        notes.append(note)
-                    self.cases[id_name] = PracticeCaseAsScore(id_name, key, notes)
-                elif type_name == "chord":
-                    pass   ##### TODO #####
-                elif type_name == "sound":
-                    id_name = case.get("id")
-                    notes = list()
-                    for note_node in case.findall("./notes/note"):
-                        note_name = note_node.get("name")
-                        note_step = note_node.get("step")
-                        if note_step:
-                            note = Note(note_name, note_step)
-                        else:
-                            note = Note(note_name)
-                        notes.append(note)
-                    self.cases[id_name] = PracticeCaseAsSound(id_name, notes)
-                else:
-                    pass   # Unexpected case. Nothing to do....
+    def __init__(self, directory, columnar = False, generator = None):
+        self.cases = dict()   # Materialized cases only
+        self.generator = generator   # Creates cases whose ids are not in the catalog
+        self.catalog = None
+        self.index = None
+        self.columns = None
+        create_catalog = lambda: Catalog(directory, PracticeCases.parse_file, PracticeCases.get_record_id)
+        if columnar:
+            self.columns = ColumnarCases.open(directory, create_catalog)
+        else:
+            self.catalog = create_catalog()
+            self.index = self.catalog.get_index()
+
+    @staticmethod
+    def get_record_id(record):
+        return record[1]
+
+    def get_duplicates(self):
+        if self.columns is not None:
+            return self.columns.get_duplicates()
+        return self.catalog.get_duplicates()
+
+    @staticmethod
+    def parse_file(xml_filename):
+        records = list()
+        for case in Catalog.iterate_elements(xml_filename, "case"):
+            type_name = case.get("type")
+            if type_name == "score":
+                attribute = case.find("./score").get("key")
+            elif type_name == "chord":
+                chord = case.find("./chord")
+                attribute = (chord.get("name"), chord.get("inversions") == "True", int(chord.get("octave", "4")))
+            else:
+                attribute = None
+            notes = tuple((note_node.get("name"), note_node.get("step")) for note_node in case.findall("./notes/note"))
+            records.append((type_name, case.get("id"), attribute, notes))
+        return records
+
+    @staticmethod
+    def create_case(record):
+        (type_name, id_name, attribute, note_records) = record
+        notes = list()
+        for (note_name, note_step) in note_records:
+            notes.append(Note.get_instance(note_name, note_step))
+        if type_name == "score":
+            return PracticeCaseAsScore(id_name, attribute, notes)
+        elif type_name == "chord":
+            (chord, allows_inversions, octave) = attribute
+            notes = PracticeCaseAsChord.resolve_voicing(notes, octave)
+            return PracticeCaseAsChord(id_name, chord, notes, allows_inversions)
+        elif type_name == "sound":
+            return PracticeCaseAsSound(id_name, notes)
+        else:
+            return None   # Unexpected case. Nothing to do....
 
     def get_by_id(self, id_name):
+        if id_name not in self.cases:
+            self.load([id_name])
+        if (id_name not in self.cases) and (self.generator is not None):
+            record = self.generator.create_record(id_name)
+            case = PracticeCases.create_case(record) if record is not None else None
+            if case is not None:
+                self.cases[id_name] = case
         return self.cases[id_name]
 
+    def load(self, id_names):   # Generated cases are not preloaded. They are created on demand.
+        if self.columns is not None:
+            for id_name in id_names:
+                if (id_name not in self.cases) and self.columns.contains(id_name):
+                    case = PracticeCases.create_case(self.columns.get_record(id_name))
+                    if case is not None:
+                        self.cases[case.get_id()] = case
+            return
+        positions_by_file = dict()
+        for id_name in id_names:
+            if (id_name not in self.cases) and (id_name in self.index):
+                (xml_filename, position) = self.index[id_name]
+                positions_by_file.setdefault(xml_filename, list()).append(position)
+        for (xml_filename, positions) in positions_by_file.items():
+            records = self.catalog.get_records_in(xml_filename)
+            for position in positions:
+                case = PracticeCases.create_case(records[position])
+                if case is not None:
+                    self.cases[case.get_id()] = case
+
+    def get_record(self, id_name):   # From the catalog, else from the generator. None if unknown.
+        if self.columns is not None:
+            if self.columns.contains(id_name):
+                return self.columns.get_record(id_name)
+        elif id_name in self.index:
+            (xml_filename, position) = self.index[id_name]
+            return self.catalog.get_records_in(xml_filename)[position]
+        if self.generator is not None:
+            return self.generator.create_record(id_name)
+        return None
+
+    def get_ids(self):
+        if self.columns is not None:
+            return self.columns.get_ids()
+        return list(self.index.keys())
+
+    def get_records(self):
+        if self.columns is not None:
+            return self.columns.get_records()
+        return self.catalog.get_records()
+
+
+class CaseIndex(object):
+
+    CRITERIA = ("type", "key", "lowest", "highest", "lines", "size")   # Attributes of a <query> in a suite
+    NO_LINES = 255        # Line count of records that have no place on the staff
+    NO_NUMBER = -1        # Note number of records that have no pitch
+    MAX_NUMBER = 127      # Highest MIDI note number
+
+    def __init__(self, practice_cases, layout):
+        self.practice_cases = practice_cases
+        self.layout = layout
+        self.ids = None   # Built on the first query
+
+    def build(self):
+        self.ids = list()
+        self.by_type = dict()
+        self.by_key = dict()
+        self.by_size = dict()
+        self.by_lines = [set() for _ in range(len(Layout.LINE_KEYS) + 1)]
+        self.line_counts = array.array("B")   # Per position, so narrowed candidates are filtered without building sets.
+        self.lowest_at = array.array("h")
+        self.highest_at = array.array("h")
+        lowest = list()
+        highest = list()
+        for (position, (type_name, id_name, attribute, notes)) in enumerate(self.practice_cases.get_records()):
+            self.ids.append(id_name)
+            self.line_counts.append(CaseIndex.NO_LINES)
+            self.lowest_at.append(CaseIndex.NO_NUMBER)
+            self.highest_at.append(CaseIndex.NO_NUMBER)
+            self.by_type.setdefault(type_name, set()).add(position)
+            self.by_key.setdefault(attribute[0] if type_name == "chord" else attribute, set()).add(position)
+            self.by_size.setdefault(len(notes), set()).add(position)
+            try:   # Octave-less chord notes have neither a pitch nor a place on the staff.
+                numbers = [self.layout.get_note_number(name) for (name, step) in notes]
+                line_mask = 0
+                for (name, step) in notes:
+                    line_mask = line_mask | self.layout.get_line_mask_of(Note.get_instance(name, step))
+            except (KeyError, ValueError, IndexError):
+                continue
+            if len(numbers) > 0:
+                self.lowest_at[position] = min(numbers)
+                self.highest_at[position] = max(numbers)
+                lowest.append((min(numbers), position))
+                highest.append((max(numbers), position))
+            self.line_counts[position] = bin(line_mask).count("1")
+            self.by_lines[self.line_counts[position]].add(position)
+        lowest.sort()
+        highest.sort()
+        self.lowest_numbers = [number for (number, position) in lowest]
+        self.lowest_positions = [position for (number, position) in lowest]
+        self.highest_numbers = [number for (number, position) in highest]
+        self.highest_positions = [position for (number, position) in highest]
+
+    def resolve(self, criteria):
+        if self.ids is None:
+            self.build()
+        candidates = None
+        for (name, index, convert) in (("type", self.by_type, str), ("key", self.by_key, str), ("size", self.by_size, int)):
+            if name not in criteria:
+                continue
+            matched = index.get(convert(criteria[name]), set())
+            candidates = matched if candidates is None else candidates.intersection(matched)   # Never changed in place.
+        ranges = list()   # (size of its scan, scan, values per position, lowest, highest) for each range criterion
+        if "lines" in criteria:
+            lines = int(criteria["lines"])
+            ranges.append((sum(len(positions) for positions in self.by_lines[:lines + 1]),
+                           lambda: set().union(*self.by_lines[:lines + 1]), self.line_counts, 0, lines))
+        if "lowest" in criteria:
+            lowest_number = self.layout.get_note_number(criteria["lowest"])
+            start = bisect.bisect_left(self.lowest_numbers, lowest_number)
+            ranges.append((len(self.lowest_positions) - start, lambda: self.lowest_positions[start:],
+                           self.lowest_at, lowest_number, CaseIndex.MAX_NUMBER))
+        if "highest" in criteria:
+            highest_number = self.layout.get_note_number(criteria["highest"])
+            end = bisect.bisect_right(self.highest_numbers, highest_number)
+            ranges.append((end, lambda: self.highest_positions[:end], self.highest_at, 0, highest_number))
+        if candidates is None:   # No equality index applies. Start from the narrowest range scan.
+            if len(ranges) == 0:
+                return list(self.ids)
+            ranges.sort(key = lambda entry: entry[0])
+            candidates = ranges.pop(0)[1]()
+        for (size, scan, values, lowest, highest) in ranges:   # Sentinels of unplaced records fail every range.
+            candidates = [position for position in candidates if lowest <= values[position] <= highest]
+        return [self.ids[position] for position in sorted(candidates)]
+
+
+class CaseGenerator(object):
+
+    # Ids of generated cases spell the whole case: "Score_DM_Fs4-A4-D5_Upper" is a DM score with three notes
+    # on the upper staff, "Sound_CM_C4" is a single sound. Cases are created from the id when first used.
+    TYPES = {"Score": "score", "Sound": "sound"}
+    SIGNATURES = {"CfM": -7, "GfM": -6, "DfM": -5, "AfM": -4, "EfM": -3, "BfM": -2, "FM": -1, "CM": 0,
+                  "GM": 1, "DM": 2, "AM": 3, "EM": 4, "BM": 5, "FsM": 6, "CsM": 7}   # Flats < 0 < sharps
+    KEYS = tuple(SIGNATURES.keys())
+    SHARPS = "FCGDAEB"
+    FLATS = "BEADGCF"
+    ALTERATIONS = {"": 0, "s": 1, "f": -1}
+    PARAMETERS = ("type", "keys", "lowest", "highest", "voicing", "step")   # Attributes of a <generate> in a suite
+
+    def __init__(self, layout):
+        self.layout = layout
+
+    @staticmethod
+    def get_alteration_in_key(key, letter):
+        signature = CaseGenerator.SIGNATURES[key]
+        if letter in CaseGenerator.SHARPS[:max(signature, 0)]:
+            return 1
+        if letter in CaseGenerator.FLATS[:max(-signature, 0)]:
+            return -1
+        return 0
+
+    @staticmethod
+    def get_name(key, row, alteration = 0):
+        letter = Layout.LETTERS[row % len(Layout.LETTERS)]
+        alteration = alteration + CaseGenerator.get_alteration_in_key(key, letter)
+        accidental = [accidental for (accidental, value) in CaseGenerator.ALTERATIONS.items() if value == alteration]
+        if (len(accidental) == 0) or (row < 0):   # No double sharps or flats.
+            raise ValueError(letter + str(alteration))
+        return letter + accidental[0] + str(row // len(Layout.LETTERS))
+
+    @staticmethod
+    def format_id(type_name, key, names, step = None):
+        id_name = type_name + "_" + key + "_" + "-".join(names)
+        if step:
+            id_name = id_name + "_" + step
+        return id_name
+
+    def is_playable(self, type_name, names, step):
+        try:
+            for name in names:
+                if type_name == "Score":
+                    self.layout.get_note_position_y(name[0] + name[-1], step)
+                self.layout.get_note_number(name)
+        except (KeyError, ValueError, IndexError):
+            return False
+        return True
+
+    def generate_ids(self, type = "score", keys = "CM", lowest = "C4", highest = "C5", voicing = "0", step = None):
+        type_name = type.capitalize()
+        if keys == "all":
+            keys = " ".join(CaseGenerator.KEYS)
+        degrees = [int(degree) for degree in voicing.split()]
+        ids = list()
+        for key in keys.split():
+            for row in range(Layout.get_row(lowest[0] + lowest[-1]), Layout.get_row(highest[0] + highest[-1]) + 1):
+                try:
+                    names = [CaseGenerator.get_name(key, row + degree) for degree in degrees]
+                except ValueError:
+                    continue
+                if self.is_playable(type_name, names, step):
+                    ids.append(CaseGenerator.format_id(type_name, key, names, step))
+        return ids
+
+    def create_record(self, id_name):
+        parts = id_name.split("_")
+        if (len(parts) not in (3, 4)) or (parts[0] not in CaseGenerator.TYPES) or (parts[1] not in CaseGenerator.SIGNATURES):
+            return None
+        step = parts[3] if len(parts) == 4 else None
+        names = parts[2].split("-")
+        if (step not in Layout.STEPS) or not self.is_playable(parts[0], names, step):
+            return None
+        type_name = CaseGenerator.TYPES[parts[0]]
+        attribute = parts[1] if type_name == "score" else None
+        return (type_name, id_name, attribute, tuple((name, step) for name in names))
+
+    @staticmethod
+    def get_key_of(record):   # Key the notes of a record are spelled in, or None if it cannot be transposed
+        (type_name, id_name, attribute, notes) = record
+        if type_name == "score":
+            return attribute if attribute in CaseGenerator.SIGNATURES else None
+        if type_name == "sound":   # Sounds have no key signature. Read them in C unless the id names a key.
+            parts = id_name.split("_")
+            return parts[1] if (len(parts) > 2) and (parts[1] in CaseGenerator.SIGNATURES) else "CM"
+        return None   # Chords are matched by pitch class and have no spelled notes to move.
+
+    def transpose_id(self, id_name, key):
+        record = self.create_record(id_name)
+        if record is None:
+            return None
+        return self.transpose_record(record, key)
+
+    def transpose_record(self, record, key):   # Id of the generated case playing the record in the key, or None
+        original_key = CaseGenerator.get_key_of(record)
+        if (original_key is None) or (len(record[3]) == 0):
+            return None
+        type_name = record[0].capitalize()
+        shift = (Layout.LETTERS.index(key[0]) - Layout.LETTERS.index(original_key[0])) % len(Layout.LETTERS)
+        if shift > len(Layout.LETTERS) // 2:   # Move to the nearest tonic, up or down.
+            shift = shift - len(Layout.LETTERS)
+        names = list()
+        try:
+            for (name, step) in record[3]:
+                alteration = CaseGenerator.ALTERATIONS[name[1:-1]] - CaseGenerator.get_alteration_in_key(original_key, name[0])
+                names.append(CaseGenerator.get_name(key, Layout.get_row(name[0] + name[-1]) + shift, alteration))
+        except (KeyError, ValueError, IndexError):   # Double accidentals, octave-less or unknown note names
+            return None
+        step = record[3][0][1]
+        if not self.is_playable(type_name, names, step):
+            step = None   # Moved away from the middle of the grand staff.
+        if not self.is_playable(type_name, names, step):
+            return None
+        return CaseGenerator.format_id(type_name, key, names, step)
+
+    def transpose_record_into_keys(self, record, keys):   # (transposed ids, keys the record could not be moved into)
+        original_key = CaseGenerator.get_key_of(record)
+        transposed_ids = list()
+        failed_keys = list()
+        for key in keys:
+            if key == original_key:   # Already in the suite as it is.
+                continue
+            transposed_id = self.transpose_record(record, key)
+            if transposed_id is None:
+                failed_keys.append(key)
+            else:
+                transposed_ids.append(transposed_id)
+        return (transposed_ids, failed_keys)
+
 
 class PracticeCase(object):
 
+    __slots__ = ("id", "notes", "columns")
+    NUMBER_OF_COLUMNS = 2   # Note heads of a second sit side by side.
+
     def __init__(self, id_name, notes):
         self.id = id_name
         self.notes = notes
+        self.columns = PracticeCase.compute_columns(notes)
+
+    @staticmethod
+    def compute_columns(notes):
+        columns = [0] * len(notes)
+        previous = None
+        for index in sorted(range(len(notes)), key = lambda index: notes[index].get_position_index()):
+            position_index = notes[index].get_position_index()
+            if (previous is not None) and (position_index >= 0) and (position_index - notes[previous].get_position_index() == 1):
+                columns[index] = 1 - columns[previous]   # The upper note of a second moves to the other side.
+            previous = index
+        return tuple(columns)
 
     def get_id(self):
         return self.id
@@ -559,9 +1936,14 @@ class PracticeCase(object):
     def get_notes(self):
         return self.notes
 
+    def get_columns(self):
+        return self.columns
+
 
 class PracticeCaseAsScore(PracticeCase):
 
+    __slots__ = ("key",)
+
     def __init__(self, id_name, key, notes):
         super().__init__(id_name, notes)
         self.key = key
@@ -572,36 +1954,462 @@ class PracticeCaseAsScore(PracticeCase):
 
 class PracticeCaseAsChord(PracticeCase):
 
-    def __init__(self, id_name, chord, notes):
+    __slots__ = ("chord", "key", "allows_inversions")
+
+    def __init__(self, id_name, chord, notes, allows_inversions = False):
         super().__init__(id_name, notes)
         self.chord = chord
+        self.key = PracticeCaseAsChord.find_key(notes)
+        self.allows_inversions = allows_inversions
+
+    @staticmethod
+    def resolve_voicing(notes, octave):
+        resolved_notes = list()
+        previous_row = -1
+        for note in notes:
+            name = note.get_name()
+            if not name[-1].isdigit():   # Octave-less: the nearest octave above the previous note
+                row = Layout.get_row(name[0] + str(octave))
+                while row <= previous_row:
+                    row = row + len(Layout.LETTERS)
+                name = name + str(row // len(Layout.LETTERS))
+                note = Note.get_instance(name, note.get_step())
+            previous_row = Layout.get_row(note.get_position_name())
+            resolved_notes.append(note)
+        return resolved_notes
+
+    @staticmethod
+    def find_key(notes):   # The key signature closest to CM that spells every note without accidentals
+        keys = sorted(CaseGenerator.KEYS, key = lambda key: abs(CaseGenerator.SIGNATURES[key]))
+        for key in keys:
+            if all(CaseGenerator.ALTERATIONS[note.get_name()[1:-1]] == CaseGenerator.get_alteration_in_key(key, note.get_name()[0])
+                   for note in notes):
+                return key
+        return keys[0]
 
     def get_chord(self):
         return self.chord
 
+    def get_key(self):
+        return self.key
+
+    def is_inversion_allowed(self):
+        return self.allows_inversions
+
 
 class PracticeCaseAsSound(PracticeCase):
 
+    __slots__ = ()
+
     def __init__(self, id_name, notes):
         super().__init__(id_name, notes)
 
 
 class Note(object):
 
+    __slots__ = ("name", "step", "position_name", "position_index", "pitch_index")
+    instances = dict()   # (name, step) -> Note shared by every case
+
     def __init__(self, name, step = None):
         self.name = name
         self.step = step
+        if len(name) in (2, 3):   # "Cs4" -> "C4"
+            self.position_name = name[0] + name[-1]
+        else:
+            self.position_name = name
+        try:
+            self.position_index = Layout.get_position_index(self.position_name, step)
+            self.pitch_index = Layout.get_pitch_index(name)
+        except ValueError:   # Octave-less or unknown names have no position on the staff.
+            self.position_index = -1
+            self.pitch_index = -1
+
+    @staticmethod
+    def get_instance(name, step = None):
+        key = (name, step or None)
+        note = Note.instances.get(key)
+        if note is None:
+            note = Note(name, step or None)
+            Note.instances[key] = note
+        return note
 
     def get_name(self):
         return self.name
 
     def get_position_name(self):
-        return re.sub("^(.).?(.)$", r"\1\2", self.name)
+        return self.position_name
+
+    def get_position_index(self):
+        return self.position_index
+
+    def get_pitch_index(self):
+        return self.pitch_index
 
     def get_step(self):
         return self.step
 
 
+class Logger(threading.Thread):
+
+    LEVELS = {"Debug": 10, "Info": 20, "Warning": 30, "Error": 40}
+
+    def __init__(self, filename, props):
+        super().__init__(daemon = True)
+        self.filename = filename
+        self.level = Logger.LEVELS[props.get("LogLevel")]
+        self.format = props.get("LogFormat")
+        self.max_bytes = props.get_int("LogMaxBytes")
+        self.backup_count = props.get_int("LogBackupCount")
+        self.batch_size = props.get_int("LogBatchSize")
+        self.records = queue.Queue(props.get_int("LogQueueSize"))
+        self.log_file = open(self.filename, "a")
+        self.compressors = list()
+        self.pruning_lock = threading.Lock()
+
+    def is_enabled(self, level):
+        return Logger.LEVELS[level] >= self.level
+
+    def write(self, level, message):
+        if self.is_enabled(level):
+            self.records.put((time.time(), level, message))   # Blocks only while the queue is full.
+
+    def run(self):
+        running = True
+        while running:
+            batch = [self.records.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            for record in batch:
+                if record is None:
+                    running = False
+                else:
+                    self.write_record(record)
+            self.log_file.flush()
+            sys.stdout.flush()
+            for record in batch:
+                self.records.task_done()   # Releases flush() once everything before it is written.
+            if self.log_file.tell() >= self.max_bytes:
+                self.rotate()
+        self.log_file.close()
+        for compressor in self.compressors:
+            compressor.join()
+
+    def write_record(self, record):
+        (timestamp, level, message) = record
+        text = Logger.format_as_text(timestamp, level, message)
+        print(text)
+        if self.format == "json":
+            text = json.dumps({"time": timestamp, "level": level, "message": message}, ensure_ascii = False)
+        self.log_file.write(text + "\n")
+
+    def rotate(self):
+        self.log_file.close()
+        rotated_filename = self.filename + "." + datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        os.rename(self.filename, rotated_filename)
+        self.log_file = open(self.filename, "a")
+        self.compressors = [compressor for compressor in self.compressors if compressor.is_alive()]
+        compressor = threading.Thread(target = self.compress, args = (rotated_filename,))
+        compressor.start()
+        self.compressors.append(compressor)
+
+    def compress(self, rotated_filename):
+        with open(rotated_filename, "rb") as source, gzip.open(rotated_filename + ".gz", "wb") as destination:
+            shutil.copyfileobj(source, destination)
+        os.remove(rotated_filename)
+        with self.pruning_lock:
+            directory = os.path.dirname(self.filename) or "."
+            prefix = os.path.basename(self.filename) + "."
+            backups = sorted(name for name in os.listdir(directory) if name.startswith(prefix) and name.endswith(".gz"))
+            for name in backups[:max(0, len(backups) - self.backup_count)]:
+                os.remove(os.path.join(directory, name))
+
+    def flush(self):   # Waits until every record written so far is on the console and in the file.
+        self.records.join()
+
+    def stop(self):
+        self.records.put(None)
+        self.join()
+
+    @staticmethod
+    def format_as_text(timestamp, level, message):
+        formatted_time = datetime.datetime.fromtimestamp(timestamp).strftime("%Y%m%d-%H%M%S-%f")
+        return "[" + formatted_time + "][" + level + "] " + message
+
+
+class ReactionTimes(object):
+
+    def __init__(self):
+        self.case_histograms = dict()
+        self.suite_histograms = dict()
+
+    def record(self, suite_id, case_id, reaction_time):
+        if case_id not in self.case_histograms:
+            self.case_histograms[case_id] = Histogram()
+        if suite_id not in self.suite_histograms:
+            self.suite_histograms[suite_id] = Histogram()
+        self.case_histograms[case_id].record(reaction_time)
+        self.suite_histograms[suite_id].record(reaction_time)
+
+    def get_case_histogram(self, case_id):
+        return self.case_histograms[case_id]
+
+    def get_suite_histogram(self, suite_id):
+        return self.suite_histograms[suite_id]
+
+    def get_suite_histograms(self):
+        return self.suite_histograms
+
+
+class Histogram(object):
+
+    SUB_BITS = 4   # 16 sub-buckets per power of two, so a bucket is within 1/16 of its values.
+    SUB_COUNT = 1 << SUB_BITS
+    MAX_BITS = 31
+    NUMBER_OF_BUCKETS = (MAX_BITS - SUB_BITS + 1) * SUB_COUNT
+
+    def __init__(self):
+        self.counts = array.array("Q", [0] * Histogram.NUMBER_OF_BUCKETS)
+        self.count = 0
+        self.mean = 0.0
+        self.sum_of_squares = 0.0   # Sum of squared differences from the mean (Welford)
+        self.minimum = None
+        self.maximum = None
+
+    def record(self, value):
+        value = min(max(value, 0), (1 << Histogram.MAX_BITS) - 1)
+        self.counts[Histogram.get_index(value)] += 1
+        self.count = self.count + 1
+        delta = value - self.mean
+        self.mean = self.mean + delta / self.count
+        self.sum_of_squares = self.sum_of_squares + delta * (value - self.mean)
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+
+    def get_count(self):
+        return self.count
+
+    def get_mean(self):
+        return self.mean
+
+    def get_variance(self):
+        if self.count < 2:
+            return 0.0
+        return self.sum_of_squares / (self.count - 1)
+
+    def get_percentile(self, percentile):
+        if self.count == 0:
+            return None
+        target = max(1, -(-self.count * percentile // 100))
+        cumulative = 0
+        for (index, count) in enumerate(self.counts):
+            cumulative = cumulative + count
+            if cumulative >= target:
+                return min(Histogram.get_upper_bound(index), self.maximum)
+        return self.maximum
+
+    def __str__(self):
+        return ("n=" + str(self.count) + ", mean=" + str(int(self.mean)) +
+                ", stddev=" + str(int(self.get_variance() ** 0.5)) +
+                ", p50=" + str(self.get_percentile(50)) +
+                ", p95=" + str(self.get_percentile(95)) +
+                ", p99=" + str(self.get_percentile(99)))
+
+    @staticmethod
+    def get_index(value):
+        shift = value.bit_length() - (Histogram.SUB_BITS + 1)
+        if shift <= 0:
+            return value
+        return (shift + 1) * Histogram.SUB_COUNT + (value >> shift) - Histogram.SUB_COUNT
+
+    @staticmethod
+    def get_upper_bound(index):
+        if index < 2 * Histogram.SUB_COUNT:
+            return index
+        shift = index // Histogram.SUB_COUNT - 1
+        top = Histogram.SUB_COUNT + index % Histogram.SUB_COUNT
+        return ((top + 1) << shift) - 1
+
+
+class MidiInputReader(threading.Thread):
+
+    def __init__(self, midi_input_device, event_type, poll_interval, idle_poll_interval = 0.02, active_window = 1.0):
+        super().__init__(daemon = True)
+        self.midi_input_device = midi_input_device
+        self.event_type = event_type
+        self.poll_interval = poll_interval             # Seconds between polls while the keyboard is played
+        self.idle_poll_interval = idle_poll_interval   # Seconds between polls once it has been quiet for active_window
+        self.active_window = active_window
+        self.stopped = threading.Event()
+        self.awaiting = threading.Event()   # Set while a case waits for its answer. Polls fast regardless of activity.
+
+    def run(self):
+        last_received_time = 0
+        while not self.stopped.is_set():
+            if not self.midi_input_device.poll():   # PortMidi has no blocking read.
+                is_active = (time.perf_counter_ns() - last_received_time) < self.active_window * 1000000000
+                if self.awaiting.is_set() or is_active:
+                    self.stopped.wait(self.poll_interval)
+                else:
+                    self.awaiting.wait(self.idle_poll_interval)   # Wakes up as soon as a case is displayed.
+                continue
+            received_time = time.perf_counter_ns()
+            last_received_time = received_time
+            for raw_event in self.midi_input_device.read(10):
+                event = pygame.event.Event(self.event_type, raw_event = raw_event, received_time = received_time)
+                pygame.fastevent.post(event)
+
+    def set_awaiting(self, is_awaiting):
+        if is_awaiting:
+            self.awaiting.set()
+        else:
+            self.awaiting.clear()
+
+    def stop(self):
+        self.stopped.set()
+        self.awaiting.set()
+        self.join()
+
+
+class ChordRecognizer(object):
+
+    NUMBER_OF_PITCH_CLASSES = 12
+    ROOT_NAMES = ("C", "Cs", "D", "Ef", "E", "F", "Fs", "G", "Af", "A", "Bf", "B")
+    QUALITIES = (("", (0, 4, 7)), ("m", (0, 3, 7)), ("dim", (0, 3, 6)), ("aug", (0, 4, 8)),
+                 ("sus4", (0, 5, 7)), ("sus2", (0, 2, 7)), ("7", (0, 4, 7, 10)), ("M7", (0, 4, 7, 11)),
+                 ("m7", (0, 3, 7, 10)), ("mM7", (0, 3, 7, 11)), ("m7-5", (0, 3, 6, 10)), ("dim7", (0, 3, 6, 9)),
+                 ("6", (0, 4, 7, 9)), ("m6", (0, 3, 7, 9)), ("7sus4", (0, 5, 7, 10)), ("aug7", (0, 4, 8, 10)),
+                 ("5", (0, 7)))   # Earlier qualities win when two chords share their pitch classes (C6 = Am7).
+    table = None   # Pitch-class mask -> (root, quality index), built on first use
+
+    def __init__(self):
+        self.held = 0   # Bit n is MIDI note n.
+        self.counts = [0] * ChordRecognizer.NUMBER_OF_PITCH_CLASSES   # Held notes per pitch class
+        self.mask = 0   # Bit n is pitch class n.
+        ChordRecognizer.get_table()
+
+    @staticmethod
+    def get_table():
+        if ChordRecognizer.table is None:
+            table = [None] * (1 << ChordRecognizer.NUMBER_OF_PITCH_CLASSES)
+            for (quality_index, (quality, intervals)) in enumerate(ChordRecognizer.QUALITIES):
+                for root in range(ChordRecognizer.NUMBER_OF_PITCH_CLASSES):
+                    mask = ChordRecognizer.get_pitch_class_mask(root + interval for interval in intervals)
+                    if table[mask] is None:
+                        table[mask] = (root, quality_index)
+            ChordRecognizer.table = table
+        return ChordRecognizer.table
+
+    @staticmethod
+    def get_pitch_class_bit(note_number):
+        return 1 << (note_number % ChordRecognizer.NUMBER_OF_PITCH_CLASSES)
+
+    @staticmethod
+    def get_pitch_class_mask(note_numbers):
+        mask = 0
+        for note_number in note_numbers:
+            mask = mask | ChordRecognizer.get_pitch_class_bit(note_number)
+        return mask
+
+    def reset(self):
+        self.held = 0
+        self.counts = [0] * ChordRecognizer.NUMBER_OF_PITCH_CLASSES
+        self.mask = 0
+
+    def note_on(self, note_number):
+        if not self.held & (1 << note_number):
+            self.held = self.held | (1 << note_number)
+            pitch_class = note_number % ChordRecognizer.NUMBER_OF_PITCH_CLASSES
+            self.counts[pitch_class] = self.counts[pitch_class] + 1
+            self.mask = self.mask | (1 << pitch_class)
+
+    def note_off(self, note_number):
+        if self.held & (1 << note_number):
+            self.held = self.held & ~(1 << note_number)
+            pitch_class = note_number % ChordRecognizer.NUMBER_OF_PITCH_CLASSES
+            self.counts[pitch_class] = self.counts[pitch_class] - 1
+            if self.counts[pitch_class] == 0:
+                self.mask = self.mask & ~(1 << pitch_class)
+
+    def get_mask(self):
+        return self.mask
+
+    def get_bass(self):
+        if self.held == 0:
+            return None
+        return (self.held & -self.held).bit_length() - 1
+
+    def recognize(self):   # (root, quality, inversion) of the held notes, or None
+        entry = ChordRecognizer.table[self.mask]
+        if entry is None:
+            return None
+        (root, quality_index) = entry
+        (quality, intervals) = ChordRecognizer.QUALITIES[quality_index]
+        bass_interval = (self.get_bass() - root) % ChordRecognizer.NUMBER_OF_PITCH_CLASSES
+        return (root, quality, intervals.index(bass_interval))
+
+    def get_name(self):
+        chord = self.recognize()
+        if chord is None:
+            return "unknown(" + format(self.mask, "012b") + ")"
+        (root, quality, inversion) = chord
+        name = ChordRecognizer.ROOT_NAMES[root] + quality
+        if inversion > 0:
+            name = name + "/" + ChordRecognizer.ROOT_NAMES[self.get_bass() % ChordRecognizer.NUMBER_OF_PITCH_CLASSES]
+        return name
+
+
+class KeyboardState(object):
+
+    SUSTAIN_PEDAL = 64   # Control change number of the damper pedal
+
+    def __init__(self):
+        self.held = 0        # Bit n is set while key n is down.
+        self.sustained = 0   # Bit n is set while key n is up but kept sounding by the pedal.
+        self.is_sustaining = False
+        self.targets = 0     # Keys of the current answer
+        self.remaining = 0   # Targets not sounding yet
+
+    def set_targets(self, note_numbers):   # Only keys pressed after the case was displayed count.
+        self.held = 0
+        self.sustained = 0
+        self.targets = 0
+        for note_number in note_numbers:
+            self.targets = self.targets | (1 << note_number)
+        self.remaining = bin(self.targets).count("1")
+
+    def note_on(self, note_number):   # True if the key is one of the targets
+        bit = 1 << note_number
+        if (self.targets & bit) and not ((self.held | self.sustained) & bit):
+            self.remaining = self.remaining - 1
+        self.held = self.held | bit
+        self.sustained = self.sustained & ~bit
+        return (self.targets & bit) != 0
+
+    def note_off(self, note_number):
+        bit = 1 << note_number
+        if not self.held & bit:
+            return
+        self.held = self.held & ~bit
+        if self.is_sustaining:
+            self.sustained = self.sustained | bit
+        elif self.targets & bit:
+            self.remaining = self.remaining + 1
+
+    def control_change(self, control_number, value):
+        if control_number != KeyboardState.SUSTAIN_PEDAL:
+            return
+        self.is_sustaining = value >= 64
+        if not self.is_sustaining:
+            self.remaining = self.remaining + bin(self.sustained & self.targets).count("1")
+            self.sustained = 0
+
+    def is_complete(self):
+        return self.remaining == 0
+
+
 class MidiEvent(object):
 
     def __init__(self, event):
@@ -638,12 +2446,29 @@ class MidiEvent(object):
             return True
         return False
 
+    def is_control_change(self):
+        if self.raw_event == None:
+            return False
+        if self.get_status() == 0xB0:
+            return True
+        return False
+
 
 class SystemContinuationException(Exception):
     
     pass
 
 
+class InvalidPropertiesException(Exception):
+
+    pass
+
+
+class EmptySuiteException(Exception):
+
+    pass
+
+
 class NotFoundMidiDeviceException(Exception):
 
     pass
@@ -654,8 +2479,298 @@ class NotFoundMidiInputDeviceException(Exception):
     pass
 
 
+class TestPyPiano(unittest.TestCase):
+    """ Test suite for PyPiano """
+
+    @staticmethod
+    def write_case_file(filename, ids, name = "C4"):
+        with open(filename, "w") as case_file:
+            case_file.write('<?xml version="1.0" encoding="UTF-8"?>\n<cases>\n')
+            for id_name in ids:
+                case_file.write('  <case type="sound" id="' + id_name + '"><notes><note name="' + name + '" /></notes></case>\n')
+            case_file.write("</cases>\n")
+
+    def test_alias_sampler(self):
+        """ Test case for AliasSampler """
+        weights = [1, 2, 3, 4, 0]
+        sampler = AliasSampler(weights)
+        size = len(weights)
+        masses = [0.0] * size   # Probability of each index implied by the table
+        for index in range(size):
+            masses[index] = masses[index] + sampler.probabilities[index] / size
+            masses[sampler.aliases[index]] = masses[sampler.aliases[index]] + (1.0 - sampler.probabilities[index]) / size
+        for (index, weight) in enumerate(weights):
+            self.assertAlmostEqual(masses[index], weight / sum(weights))
+        random_generator = random.Random(0)
+        counts = collections.Counter(sampler.sample(random_generator) for _ in range(100000))
+        self.assertEqual(counts[4], 0)
+        for (index, weight) in enumerate(weights[:4]):
+            self.assertAlmostEqual(counts[index] / 100000, weight / sum(weights), delta = 0.01)
+        self.assertRaises(ValueError, AliasSampler, [0, 0])
+
+    def test_histogram_buckets(self):
+        """ Test case for Histogram.get_index, get_upper_bound """
+        values = list(range(70000)) + [(1 << bits) + offset for bits in range(17, Histogram.MAX_BITS) for offset in (-1, 0, 1)]
+        for value in values:
+            index = Histogram.get_index(value)
+            self.assertLess(index, Histogram.NUMBER_OF_BUCKETS)
+            self.assertGreaterEqual(Histogram.get_upper_bound(index), value)
+            if index > 0:
+                self.assertLess(Histogram.get_upper_bound(index - 1), value)
+            lower_bound = Histogram.get_upper_bound(index - 1) + 1 if index > 0 else 0
+            self.assertLessEqual(Histogram.get_upper_bound(index) - lower_bound, value // Histogram.SUB_COUNT)
+        self.assertEqual(Histogram.get_index((1 << Histogram.MAX_BITS) - 1), Histogram.NUMBER_OF_BUCKETS - 1)
+        histogram = Histogram()
+        for value in (100, 200, 300, 400):
+            histogram.record(value)
+        self.assertEqual(histogram.get_percentile(50), 207)
+        self.assertEqual(histogram.get_percentile(100), 400)
+
+    def test_columnar_cases(self):
+        """ Test case for ColumnarCases.serialize, find """
+        records = [("score", "Score_CM_C4-E4-G4", "CM", (("C4", None), ("E4", None), ("G4", None))),
+                   ("sound", "Sound_CM_C4", None, (("C4", None),)),
+                   ("score", "Octave", "FM", (("F3", "Lower"), ("F4", "Upper"))),
+                   ("score", "\u30c9", "CM", (("C4", None),))]
+        duplicates = [("Octave", "a.xml", "b.xml")]
+        signature = bytes(range(20))
+        columns = ColumnarCases(ColumnarCases.serialize(signature, records, duplicates), signature)
+        self.assertEqual(sorted(columns.get_ids()), sorted(record[1] for record in records))
+        for record in records:
+            self.assertTrue(columns.contains(record[1]))
+            self.assertEqual(columns.get_record(record[1]), record)
+        for id_name in ("", "Octave_", "Score", "\uffff"):
+            self.assertEqual(columns.find(id_name), -1)
+        self.assertEqual(columns.get_duplicates(), tuple(duplicates))
+        self.assertRaises(ValueError, ColumnarCases, ColumnarCases.serialize(signature, records, duplicates), bytes(20))
+
+    def test_transpose_id(self):
+        """ Test case for CaseGenerator.transpose_id """
+        generator = CaseGenerator(Properties(PyPiano.FILE_FOR_PROPERTIES).get_layout())
+        self.assertEqual(generator.transpose_id("Score_CM_C4-E4-G4", "DM"), "Score_DM_D4-Fs4-A4")
+        self.assertEqual(generator.transpose_id("Score_CM_C4-E4-G4", "BfM"), "Score_BfM_Bf3-D4-F4")
+        self.assertEqual(generator.transpose_id("Score_CM_C4-E4-G4", "CsM"), "Score_CsM_Cs4-Es4-Gs4")
+        self.assertEqual(generator.transpose_id("Score_CM_C4-Ef4-G4", "AM"), "Score_AM_A3-C4-E4")
+        self.assertEqual(generator.transpose_id("Score_CM_Bf4", "EM"), "Score_EM_D5")
+        self.assertEqual(generator.transpose_id("Score_DM_Fs4-A4-D5", "CM"), "Score_CM_E4-G4-C5")
+        self.assertEqual(generator.transpose_id("Sound_CM_F4", "GM"), "Sound_GM_C4")
+        self.assertIsNone(generator.transpose_id("Bogus_CM_C4", "DM"))
+        octave = ("score", "Octave", "DM", (("D4", None), ("D5", None)))   # Hand-named. Read from its notes.
+        self.assertEqual(generator.transpose_record(octave, "CM"), "Score_CM_C4-C5")
+        self.assertEqual(generator.transpose_record_into_keys(octave, ("DM", "EM")), (["Score_EM_E4-E5"], []))
+        chord = ("chord", "Chord_sample_C", ("C", False, 4), (("C", None), ("E", None), ("G", None)))
+        self.assertEqual(generator.transpose_record_into_keys(chord, ("DM",)), ([], ["DM"]))
+
+    def test_chord_recognizer(self):
+        """ Test case for ChordRecognizer inversions """
+        recognizer = ChordRecognizer()
+        for (note_numbers, chord, name) in (((60, 64, 67), (0, "", 0), "C"),
+                                            ((64, 67, 72), (0, "", 1), "C/E"),
+                                            ((55, 60, 64), (0, "", 2), "C/G"),
+                                            ((53, 55, 59, 62), (7, "7", 3), "G7/F"),
+                                            ((57, 60, 64, 67), (9, "m7", 0), "Am7"),
+                                            ((60, 62), None, "unknown(000000000101)")):
+            recognizer.reset()
+            for note_number in note_numbers:
+                recognizer.note_on(note_number)
+            self.assertEqual(recognizer.recognize(), chord)
+            self.assertEqual(recognizer.get_name(), name)
+        recognizer.reset()
+        for note_number in (48, 60, 64, 67):
+            recognizer.note_on(note_number)
+        recognizer.note_off(48)   # C is still held an octave higher.
+        self.assertEqual(recognizer.recognize(), (0, "", 0))
+        recognizer.note_off(60)
+        self.assertEqual(recognizer.get_mask(), ChordRecognizer.get_pitch_class_mask((64, 67)))
+
+    def test_keyboard_state_sustain(self):
+        """ Test case for KeyboardState with the sustain pedal """
+        state = KeyboardState()
+        state.set_targets((60, 64, 67))
+        self.assertTrue(state.note_on(60))
+        self.assertFalse(state.note_on(61))
+        state.note_off(60)
+        self.assertFalse(state.is_complete())
+        self.assertEqual(state.remaining, 3)
+        state.control_change(KeyboardState.SUSTAIN_PEDAL, 127)
+        for note_number in (60, 64):
+            state.note_on(note_number)
+            state.note_off(note_number)   # Kept sounding by the pedal.
+        state.note_on(60)   # Pressed again while sustained. Counts once.
+        state.note_on(67)
+        self.assertTrue(state.is_complete())
+        state.control_change(1, 0)   # Not the pedal.
+        self.assertTrue(state.is_complete())
+        state.control_change(KeyboardState.SUSTAIN_PEDAL, 0)
+        self.assertFalse(state.is_complete())
+        self.assertEqual(state.remaining, 1)   # Only E4 stopped sounding.
+        state.set_targets((60,))
+        self.assertFalse(state.is_complete())
+
+    def test_catalog_cache(self):
+        """ Test case for Catalog reusing and invalidating its cache """
+        parsed_filenames = list()
+        def parse_file(xml_filename):
+            parsed_filenames.append(os.path.basename(xml_filename))
+            return PracticeCases.parse_file(xml_filename)
+        with tempfile.TemporaryDirectory() as directory:
+            TestPyPiano.write_case_file(os.path.join(directory, "a.xml"), ["A1", "A2"])
+            TestPyPiano.write_case_file(os.path.join(directory, "b.xml"), ["B1"])
+            catalog = Catalog(directory, parse_file, PracticeCases.get_record_id)
+            self.assertEqual(sorted(parsed_filenames), ["a.xml", "b.xml"])
+            self.assertEqual(sorted(catalog.get_index().keys()), ["A1", "A2", "B1"])
+            with open(os.path.join(directory, Catalog.FILENAME), "rb") as catalog_file:
+                header = json.loads(catalog_file.readline())   # Data only
+            self.assertEqual(header["version"], Catalog.VERSION)
+            del parsed_filenames[:]
+            catalog = Catalog(directory, parse_file, PracticeCases.get_record_id)
+            self.assertEqual(parsed_filenames, [])
+            self.assertEqual(list(catalog.get_records()), [("sound", "A1", None, (("C4", None),)),
+                                                           ("sound", "A2", None, (("C4", None),)),
+                                                           ("sound", "B1", None, (("C4", None),))])
+            TestPyPiano.write_case_file(os.path.join(directory, "b.xml"), ["B1", "B2"])
+            catalog = Catalog(directory, parse_file, PracticeCases.get_record_id)
+            self.assertEqual(parsed_filenames, ["b.xml"])
+            self.assertEqual(sorted(catalog.get_index().keys()), ["A1", "A2", "B1", "B2"])
+            os.remove(os.path.join(directory, "a.xml"))
+            catalog = Catalog(directory, parse_file, PracticeCases.get_record_id)
+            self.assertEqual(sorted(catalog.get_index().keys()), ["B1", "B2"])
+            with open(os.path.join(directory, Catalog.FILENAME), "wb") as catalog_file:
+                catalog_file.write(b'{"version": 0, "entries": {}}\n')   # Foreign or older catalog
+            del parsed_filenames[:]
+            catalog = Catalog(directory, parse_file, PracticeCases.get_record_id)
+            self.assertEqual(parsed_filenames, ["b.xml"])
+
+    def test_catalog_offsets(self):
+        """ Test case for Catalog.save, read_text offsets """
+        with tempfile.TemporaryDirectory() as directory:
+            for (filename, ids) in (("a.xml", ["A1"]), ("b.xml", ["B1", "B2"]), ("c.xml", ["C1", "C2", "C3"])):
+                TestPyPiano.write_case_file(os.path.join(directory, filename), ids)
+            Catalog(directory, PracticeCases.parse_file, PracticeCases.get_record_id)
+            TestPyPiano.write_case_file(os.path.join(directory, "b.xml"), ["B1", "B2", "B3", "B4"], "Fs5")   # Grows in the middle.
+            catalog = Catalog(directory, PracticeCases.parse_file, PracticeCases.get_record_id)
+            self.assertEqual(catalog.texts, dict())   # Everything is read back from the file.
+            offset = 0
+            for xml_filename in sorted(catalog.entries.keys()):
+                (mtime_ns, size, ids, entry_offset, length) = catalog.entries[xml_filename]
+                self.assertEqual(entry_offset, offset)
+                offset = offset + length
+                self.assertEqual(list(catalog.get_records_in(xml_filename)), PracticeCases.parse_file(xml_filename))
+            self.assertEqual(catalog.get_index()["B3"], (os.path.join(directory, "b.xml"), 2))
+            cases = PracticeCases(directory)
+            self.assertEqual(cases.get_record("B4"), ("sound", "B4", None, (("Fs5", None),)))
+            self.assertEqual(cases.get_record("C3"), ("sound", "C3", None, (("C4", None),)))
+            with open(os.path.join(directory, Catalog.FILENAME), "r+b") as catalog_file:
+                catalog_file.truncate(catalog.body_offset + 10)
+            c_filename = os.path.join(directory, "c.xml")
+            self.assertRaises(ValueError, catalog.read_text, c_filename)
+            self.assertEqual(list(catalog.get_records_in(c_filename)), PracticeCases.parse_file(c_filename))   # Parsed again.
+
+    def test_duplicates(self):
+        """ Test case for duplicate ids across and within files """
+        with tempfile.TemporaryDirectory() as directory:
+            filenames = [os.path.join(directory, filename) for filename in ("a.xml", "b.xml", "c.xml", "d.xml")]
+            for (filename, ids) in zip(filenames, (["X", "Y"], ["Y", "Z"], ["X"], ["W", "W"])):   # Enough files to parse in parallel
+                TestPyPiano.write_case_file(filename, ids)
+            expected = [("Y", filenames[0], filenames[1]), ("X", filenames[0], filenames[2]), ("W", filenames[3], filenames[3])]
+            catalog = Catalog(directory, PracticeCases.parse_file, PracticeCases.get_record_id)
+            self.assertEqual(catalog.get_duplicates(), expected)
+            self.assertEqual(catalog.get_index()["Y"], (filenames[0], 1))   # The first definition in file order is used.
+            self.assertEqual([record[1] for record in catalog.get_records()], ["X", "Y", "Z", "W"])
+            self.assertEqual(list(Catalog(directory, PracticeCases.parse_file, PracticeCases.get_record_id).get_duplicates()), expected)
+            self.assertEqual(list(PracticeCases(directory, True).get_duplicates()), expected)
+
+    def test_shuffle_bag(self):
+        """ Test case for PracticeSuite shuffle mode """
+        for rates in ([("a", 1), ("b", 1), ("c", 1)], [("a", 1), ("b", 5), ("c", 0), ("d", 20), ("e", 2)]):
+            suite = PracticeSuite("Shuffled", rates, PracticeSuite.MODE_SHUFFLE, 0)
+            served_ids = sorted(case_id for (case_id, rate) in rates if rate > 0)
+            chosen_ids = [suite.choose_one_id() for _ in range(len(served_ids) * 200)]
+            for start in range(0, len(chosen_ids), len(served_ids)):   # Every case once per bag
+                self.assertEqual(sorted(chosen_ids[start:start + len(served_ids)]), served_ids)
+            for (previous_id, chosen_id) in zip(chosen_ids, chosen_ids[1:]):   # Not even across bags
+                self.assertNotEqual(previous_id, chosen_id)
+        suite = PracticeSuite("Single", [("a", 1)], PracticeSuite.MODE_SHUFFLE, 0)
+        self.assertEqual([suite.choose_one_id() for _ in range(3)], ["a", "a", "a"])
+
+    def test_repetition_schedule(self):
+        """ Test case for RepetitionScheduler.load, save """
+        scheduler = RepetitionScheduler(["a", "b", "c"])
+        scheduler.record_answer("a", 0, 100)
+        scheduler.record_answer("b", 2, 100)
+        scheduler.record_answer("a", 0, 3000000)
+        self.assertEqual(scheduler.choose_one_id(), "c")   # Never answered, so due first.
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "schedules", "Suite.dat")
+            scheduler.save(filename)
+            loaded = RepetitionScheduler(["a", "b", "c", "d"])   # "d" was added to the suite since.
+            loaded.load(filename)
+            for case_id in ("a", "b", "c"):
+                for (value, expected) in zip(loaded.states[case_id], scheduler.states[case_id]):
+                    self.assertAlmostEqual(value, expected, places = 4)
+            self.assertEqual(loaded.states["d"][2], 0)
+            self.assertIn(loaded.choose_one_id(), ("c", "d"))   # Both never answered
+            shrunk = RepetitionScheduler(["b"])   # Cases removed from the suite are forgotten.
+            shrunk.load(filename)
+            self.assertEqual(list(shrunk.states.keys()), ["b"])
+            with open(filename, "rb") as schedule_file:
+                data = schedule_file.read()
+            for broken_data in (data[:-3], b"\x05\x00ab", b"\x02\x00\xff\xfe" + data[4:]):
+                with open(filename, "wb") as schedule_file:
+                    schedule_file.write(broken_data)
+                fresh = RepetitionScheduler(["a", "b", "c"])
+                self.assertRaises(ValueError, fresh.load, filename)
+                self.assertEqual([state[2] for state in fresh.states.values()], [0, 0, 0])   # Left untouched
+            RepetitionScheduler(["a"]).load(os.path.join(directory, "missing.dat"))
+        suite = PracticeSuite("Adaptive", [("a", 1), ("b", 0)], PracticeSuite.MODE_ADAPTIVE, 0)
+        for _ in range(5):
+            chosen_id = suite.choose_one_id()
+            self.assertEqual(chosen_id, "a")
+            suite.record_answer(chosen_id, 0, 100)
+
+    def test_case_index(self):
+        """ Test case for CaseIndex.resolve """
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "cases.xml"), "w") as case_file:
+                case_file.write('<?xml version="1.0" encoding="UTF-8"?>\n<cases>\n'
+                                '  <case type="score" id="Score_E4"><score key="CM" /><notes><note name="E4" /></notes></case>\n'
+                                '  <case type="score" id="Score_C6"><score key="CM" /><notes><note name="C6" /></notes></case>\n'
+                                '  <case type="score" id="Score_Triad"><score key="CM" />'
+                                '<notes><note name="C4" /><note name="E4" /><note name="G4" /></notes></case>\n'
+                                '  <case type="score" id="Score_A5"><score key="DM" /><notes><note name="A5" /></notes></case>\n'
+                                '  <case type="sound" id="Sound_G4"><notes><note name="G4" /></notes></case>\n'
+                                '  <case type="chord" id="Chord_C"><chord name="C" />'
+                                '<notes><note name="C" /><note name="E" /><note name="G" /></notes></case>\n'
+                                '</cases>\n')
+            for columnar in (False, True):
+                index = CaseIndex(PracticeCases(directory, columnar), Properties(PyPiano.FILE_FOR_PROPERTIES).get_layout())
+                for (criteria, expected) in (({}, ["Score_E4", "Score_C6", "Score_Triad", "Score_A5", "Sound_G4", "Chord_C"]),
+                                             ({"type": "score"}, ["Score_E4", "Score_C6", "Score_Triad", "Score_A5"]),
+                                             ({"key": "CM"}, ["Score_E4", "Score_C6", "Score_Triad"]),
+                                             ({"key": "C"}, ["Chord_C"]),
+                                             ({"type": "sound", "key": "CM"}, []),
+                                             ({"lines": "0"}, ["Score_E4", "Sound_G4"]),
+                                             ({"key": "CM", "lines": "1"}, ["Score_E4", "Score_Triad"]),
+                                             ({"lowest": "E4"}, ["Score_E4", "Score_C6", "Score_A5", "Sound_G4"]),
+                                             ({"highest": "G4"}, ["Score_E4", "Score_Triad", "Sound_G4"]),
+                                             ({"key": "CM", "lowest": "C4", "highest": "G4"}, ["Score_E4", "Score_Triad"]),
+                                             ({"lines": "2", "lowest": "C4", "highest": "A5"}, ["Score_E4", "Score_Triad", "Score_A5", "Sound_G4"]),
+                                             ({"size": "3"}, ["Score_Triad", "Chord_C"]),
+                                             ({"size": "3", "lowest": "C2"}, ["Score_Triad"]),   # Chords have no pitch.
+                                             ({"size": "3", "lines": "2"}, ["Score_Triad"]),
+                                             ({"size": "3", "highest": "G4"}, ["Score_Triad"])):
+                    self.assertEqual(sorted(index.resolve(criteria)), sorted(expected))   # Columnar records are ordered by id.
+
+
 def main():
     """ Main routine """
+    if sys.argv[1:2] == ["--unittest"]:
+        unittest.main(argv = sys.argv[:1] + sys.argv[2:])
+        return 0
+    if sys.argv[1:] == ["--build-atlas"]:
+        props = Properties(PyPiano.FILE_FOR_PROPERTIES)
+        TextureAtlas.build(props.get_image_filenames(), props.get("TextureAtlas"), props.get("TextureAtlasIndex"))
+        return 0
     instance = PyPiano()
     return_code = instance.perform()
     return return_code